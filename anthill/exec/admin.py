@@ -6,6 +6,11 @@ from anthill.common import admin as a
 from . model.sources import NoSuchSourceError, SourceCodeError, JavascriptSourceError
 from . model.build import JavascriptBuildError, NoSuchClass, NoSuchMethod
 from . model.session import APIError, JavascriptSessionError
+from . model.client import APIClient, CircuitBreaker
+from . model.api import APICaches, APIBatches
+from . model.profile import ProfileWriter
+from . model.web import WebClient
+from . model.pipeline import CallPipeline
 
 from anthill.common.environment import EnvironmentClient, AppNotFound
 from anthill.common.access import AccessToken
@@ -245,6 +250,7 @@ class ServerCodeSettingsController(a.AdminController):
                                 "the repository does not exist, or the ssh key is wrong.".format(repository_url))
 
         await sources.update_server_project(self.gamespace, repository_url, repository_branch, ssh_private_key)
+        sources.invalidate_server_source(self.gamespace)
 
         raise a.Redirect("server", message="Server Code settings have been updated.")
 
@@ -406,6 +412,11 @@ class ApplicationVersionController(a.AdminController):
         if not latest_commit:
             raise a.ActionError("Failed to check the latest commit")
 
+        try:
+            await builds.publish_build(project_settings, latest_commit)
+        except JavascriptBuildError as e:
+            raise a.ActionError("Commit {0} cannot be used: {1}".format(latest_commit[:7], e.message))
+
         try:
             updated = await sources.update_commit(self.gamespace, app_id, app_version, latest_commit)
         except SourceCodeError as e:
@@ -530,6 +541,11 @@ class ApplicationVersionController(a.AdminController):
         if not commit_exists:
             raise a.ActionError("No such commit")
 
+        try:
+            await builds.publish_build(project_settings, commit)
+        except JavascriptBuildError as e:
+            raise a.ActionError("Commit {0} cannot be used: {1}".format(commit[:7], e.message))
+
         try:
             await sources.update_commit(self.gamespace, app_id, app_version, commit)
         except SourceCodeError as e:
@@ -717,11 +733,18 @@ class ServerCodeController(a.AdminController):
         if not latest_commit:
             raise a.ActionError("Failed to check the latest commit")
 
+        try:
+            await builds.publish_server_build(project_settings, latest_commit)
+        except JavascriptBuildError as e:
+            raise a.ActionError("Commit {0} cannot be used: {1}".format(latest_commit[:7], e.message))
+
         try:
             updated = await sources.update_server_commit(self.gamespace, latest_commit)
         except SourceCodeError as e:
             raise a.ActionError(e.message)
 
+        sources.invalidate_server_source(self.gamespace)
+
         if updated:
             raise a.Redirect("server", message="Server Code has been updated")
 
@@ -736,6 +759,8 @@ class ServerCodeController(a.AdminController):
         except SourceCodeError as e:
             raise a.ActionError(e.message)
 
+        sources.invalidate_server_source(self.gamespace)
+
         if deleted:
             raise a.Redirect("server", message="Server code has been disabled")
 
@@ -798,11 +823,18 @@ class ServerCodeController(a.AdminController):
         if not commit_exists:
             raise a.ActionError("No such commit")
 
+        try:
+            await builds.publish_server_build(project_settings, commit)
+        except JavascriptBuildError as e:
+            raise a.ActionError("Commit {0} cannot be used: {1}".format(commit[:7], e.message))
+
         try:
             await sources.update_server_commit(self.gamespace, commit)
         except SourceCodeError as e:
             raise a.ActionError(e.message)
 
+        sources.invalidate_server_source(self.gamespace)
+
         raise a.Redirect("server", message="Server code commit has been updated")
 
     def render(self, data):
@@ -920,6 +952,7 @@ class RootAdminController(a.AdminController):
             a.links("Exec service", [
                 a.link("apps", "Applications", icon="mobile"),
                 a.link("server", "Server Code", icon="server"),
+                a.link("status", "Status", icon="heartbeat"),
             ])
         ]
 
@@ -952,3 +985,90 @@ class FunctionsController(a.AdminController):
 
     def access_scopes(self):
         return ["exec_admin"]
+
+
+class StatusController(a.AdminController):
+    BREAKER_STYLES = {
+        CircuitBreaker.CLOSED: "success",
+        CircuitBreaker.HALF_OPEN: "warning",
+        CircuitBreaker.OPEN: "danger"
+    }
+
+    async def get(self):
+        client = APIClient().stats()
+
+        return {
+            "services": client["services"],
+            "connections": client["connections"],
+            "caches": APICaches().stats(),
+            "batches": APIBatches().stats(),
+            "profile_updates": ProfileWriter().stats(),
+            "web": WebClient().stats(),
+            "calls": CallPipeline().stats.dump(),
+            "git": self.application.builds.git.stats()
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Status"),
+            a.content(title="Services", headers=[
+                {
+                    "id": "service",
+                    "title": "Service"
+                },
+                {
+                    "id": "breaker",
+                    "title": "Circuit Breaker"
+                },
+                {
+                    "id": "requests",
+                    "title": "Requests"
+                },
+                {
+                    "id": "errors",
+                    "title": "Errors"
+                },
+                {
+                    "id": "in_flight",
+                    "title": "In Flight"
+                },
+                {
+                    "id": "rejected",
+                    "title": "Rejected"
+                },
+                {
+                    "id": "avg_time",
+                    "title": "Average Time"
+                }
+            ], items=[
+                {
+                    "service": service,
+                    "breaker": [
+                        a.status(stats["breaker"]["state"],
+                                 StatusController.BREAKER_STYLES.get(stats["breaker"]["state"], "default"))
+                    ],
+                    "requests": stats["requests"],
+                    "errors": stats["errors"],
+                    "in_flight": stats["in_flight"],
+                    "rejected": stats["rejected"],
+                    "avg_time": "{0:.3f}s".format(stats["avg_time"])
+                }
+                for service, stats in sorted(data["services"].items())
+            ], style="primary"),
+            a.json_view({
+                "services": data["services"],
+                "connections": data["connections"],
+                "caches": data["caches"],
+                "batches": data["batches"],
+                "profile_updates": data["profile_updates"],
+                "web": data["web"],
+                "calls": data["calls"],
+                "git": data["git"]
+            }),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["exec_admin"]
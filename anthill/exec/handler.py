@@ -307,13 +307,17 @@ class CallServerActionHandler(handler.AuthenticatedHandler):
         builds = self.application.builds
         sources = self.application.sources
 
+        gamespaces = self.application.gamespaces
         login_client = LoginClient(self.application.cache)
 
         try:
-            gamespace_info = await login_client.find_gamespace(gamespace_name)
+            gamespace_info = await gamespaces.get(gamespace_name, login_client.find_gamespace, gamespace_name)
         except LoginClientError as e:
             raise HTTPError(e.code, e.message)
 
+        if gamespace_info is None:
+            raise HTTPError(404, "No such gamespace: {0}".format(gamespace_name))
+
         gamespace_id = gamespace_info.gamespace_id
 
         try:
@@ -1,17 +1,34 @@
 
 import tornado.gen
 
-from tornado.gen import sleep, Future
+from tornado.gen import sleep, multi, Future
+from tornado.locks import Semaphore
 from tornado.httpclient import HTTPRequest, HTTPError
-from tornado.simple_httpclient import SimpleAsyncHTTPClient
 
 from .. import options as _opts
-from anthill.common.internal import Internal, InternalError
-from anthill.common.validate import validate_value
+from anthill.common.options import options
+from anthill.common.validate import validate_value, ValidationError
 from anthill.common.server import Server
+from anthill.common import singleton
 from . util import promise, PromiseContext, APIError
 
+# noinspection PyUnresolvedReferences
+from v8py import new
+from . client import APIClient, RequestBatcher
+from . cache import TwoTierCache, SingleFlight, HTTPResponseCache
+from . web import WebClient, ResponseTooLarge, StreamAborted
+from . profile import ProfileWriter, split_path
+
+import asyncio
+import base64
+import codecs
+import ujson
+
 API_TIMEOUT = 5
+# maximum amount of accounts the profile service accepts in a single mass_profiles request
+MASS_PROFILES_LIMIT = 1000
+# amount of bytes passed over to javascript at once, see array_buffer (a multiple of 3, so base64 has no padding)
+BINARY_CHUNK_SIZE = 49152
 
 
 # noinspection PyUnusedLocal
@@ -23,11 +40,12 @@ async def sleep(delay, handler=None):
 # noinspection PyUnusedLocal
 @promise
 async def moment(handler=None):
-    await tornado.gen.moment
+    # tornado.gen.moment only works with the decorated coroutines
+    await asyncio.sleep(0)
 
 
 def log(message):
-    handler = PromiseContext.current
+    handler = PromiseContext.current.get()
     if handler:
         handler.log(message)
 
@@ -46,46 +64,455 @@ class AdminAPI(object):
         })
 
 
+def array_buffer(handler, data):
+    """
+    Turns bytes into an ArrayBuffer of the handler's context. v8py cannot pass bytes over to javascript,
+    so this is not free: the buffer is allocated once, and the data is base64-encoded chunk by chunk,
+    each chunk is copied into a javascript string and decoded into the buffer by javascript code.
+    That's about three copies of the data and an interpreted decoding pass, but no more than
+    BINARY_CHUNK_SIZE bytes of it are in flight at once.
+    """
+    binary = handler.context.glob.__binary__
+    buffer = binary.allocate(len(data))
+
+    view = memoryview(data)
+    for offset in range(0, len(data), BINARY_CHUNK_SIZE):
+        chunk = base64.b64encode(view[offset:offset + BINARY_CHUNK_SIZE]).decode("ascii")
+        binary.write(buffer, offset, chunk)
+
+    return buffer
+
+
+# noinspection PyUnusedLocal
+class WebStream(object):
+    """
+    A cursor over the body of a HTTP response, see WebAPI.stream.
+
+    The chunks received are passed over to the script each time it asks for the next page.
+    Once more than buffer_size bytes are waiting for the script, the response is paused until the script
+    takes them. Closing the cursor aborts the request.
+    """
+
+    def __init__(self, request, max_body_size, buffer_size, binary):
+        self.request = request
+        self.max_body_size = max_body_size
+        self.buffer_size = buffer_size
+        self.binary = binary
+        self.decoder = None if binary else codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.chunks = []
+        self.buffered = 0
+        # resolved once the script has taken the chunks, while the response is paused
+        self.resume = None
+        self.waiter = None
+        self.task = None
+        self.error = None
+        self.finished = False
+        self.closed = False
+
+    def start(self, handler):
+        self.task = asyncio.ensure_future(self.__run__())
+        handler.track(self.task)
+
+    async def __run__(self):
+        try:
+            await WebClient().fetch(self.request, max_body_size=self.max_body_size,
+                                    streaming_callback=self.__receive__)
+        except StreamAborted:
+            pass
+        except HTTPError as e:
+            self.error = APIError(e.code, e.message)
+        except ResponseTooLarge:
+            self.error = APIError(413, "Response body is larger than {0} bytes".format(self.max_body_size))
+        except Exception as e:
+            self.error = APIError(500, str(e))
+        finally:
+            if self.decoder is not None:
+                self.__append__(self.decoder.decode(b"", final=True))
+            self.finished = True
+            self.__wake__()
+
+    def __receive__(self, chunk):
+        if self.closed:
+            return False
+
+        self.buffered += len(chunk)
+
+        if self.decoder is not None:
+            chunk = self.decoder.decode(chunk)
+        self.__append__(chunk)
+        self.__wake__()
+
+        if self.buffered >= self.buffer_size:
+            self.resume = Future()
+            return self.resume
+
+    def __append__(self, chunk):
+        if chunk and not self.closed:
+            self.chunks.append(chunk)
+
+    def __wake__(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(True)
+
+    def __resume__(self, proceed=True):
+        resume, self.resume = self.resume, None
+        if resume is not None and not resume.done():
+            resume.set_result(proceed)
+
+    @promise
+    async def next(self, handler=None, *ignored):
+        while not self.chunks and not self.finished and not self.closed:
+            self.waiter = Future()
+            await self.waiter
+
+        if self.chunks:
+            page, self.chunks = self.chunks, []
+            self.buffered = 0
+            self.__resume__()
+
+            if self.binary:
+                return [array_buffer(handler, chunk) for chunk in page]
+            return page
+
+        if self.error is not None and not self.closed:
+            error, self.error = self.error, None
+            self.closed = True
+            raise error
+
+        return None
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.chunks = []
+        # a paused response is aborted right away, otherwise upon the next chunk
+        self.__resume__(False)
+        if self.task is not None:
+            self.task.cancel()
+        self.__wake__()
+
+
 # noinspection PyUnusedLocal
 class WebAPI(object):
+    METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
     def __init__(self):
-        self.http_client = SimpleAsyncHTTPClient()
-        self.rc_cache = {}
+        self.flights = SingleFlight()
 
     @promise
     async def get(self, url, headers=None, *args, **kwargs):
-        request = HTTPRequest(url=url, use_gzip=True, headers=headers)
+        cache = APICaches().web
+        key = HTTPResponseCache.key(url, headers)
+
+        entry = cache.get(key)
+        if entry is not None and entry.fresh():
+            cache.hits += 1
+            return entry.body
 
-        existing_futures = self.rc_cache.get(url, None)
+        return await self.flights.run(key, self.__fetch__, key, url, headers)
 
-        if existing_futures is not None:
-            future = Future()
-            existing_futures.append(future)
-            result = await future
-            return result
+    async def __fetch__(self, key, url, headers):
+        cache = APICaches().web
+        entry = cache.get(key)
 
-        new_futures = []
-        self.rc_cache[url] = new_futures
+        request_headers = dict(headers or {})
+        if entry is not None:
+            request_headers.update(entry.validators())
+
+        request = HTTPRequest(url=url, use_gzip=True, headers=request_headers)
 
         try:
-            response = await self.http_client.fetch(request)
+            response = await WebClient().fetch(request)
         except HTTPError as e:
-            e = APIError(e.code, e.message)
+            if e.code == 304 and entry is not None and e.response is not None:
+                cache.revalidations += 1
+                cache.revalidated(key, entry, e.response.headers)
+                return entry.body
+
+            raise APIError(e.code, e.message)
+        except ResponseTooLarge as e:
+            raise APIError(413, str(e))
 
-            for future in new_futures:
-                future.set_exception(e)
+        cache.misses += 1
+        cache.put(key, response.headers, response.body)
 
-            del self.rc_cache[url]
-            raise e
+        return response.body
+
+    @staticmethod
+    def __new_request__(method, url, body, headers, timeout):
+        method = str(method).upper()
+
+        if method not in WebAPI.METHODS:
+            raise APIError(400, "Unsupported method: " + method)
+
+        if headers is not None and not isinstance(headers, dict):
+            raise APIError(400, "Headers should be an object")
+
+        headers = dict(headers or {})
+
+        if isinstance(body, (dict, list)):
+            body = ujson.dumps(body)
+            if not any(name.lower() == "content-type" for name in headers):
+                headers["Content-Type"] = "application/json"
+        elif body is not None and not isinstance(body, (str, bytes)):
+            raise APIError(400, "Body should be a string or an object")
+
+        max_timeout = options.js_web_max_timeout
+        timeout = min(timeout, max_timeout) if isinstance(timeout, (int, float)) and timeout > 0 else max_timeout
+
+        return HTTPRequest(
+            url=url, method=method, headers=headers, body=body, use_gzip=True,
+            request_timeout=timeout, allow_nonstandard_methods=True)
+
+    @promise
+    async def request(self, method, url, body=None, headers=None, timeout=None, binary=False,
+                      handler=None, *ignored):
+        """
+        Makes a HTTP request of any method, returns an object {code, headers, body}.
+        Unlike get, does not fail upon a response with an error code, and never caches anything.
+        The body is a string, or an ArrayBuffer if binary is true.
+        """
+
+        request = WebAPI.__new_request__(method, url, body, headers, timeout)
+
+        try:
+            response = await WebClient().fetch(request, raise_error=False)
+        except HTTPError as e:
+            raise APIError(e.code, e.message)
+        except ResponseTooLarge as e:
+            raise APIError(413, str(e))
+
+        if binary:
+            response_body = array_buffer(handler, response.body or b"")
         else:
-            body = response.body
+            response_body = response.body.decode("utf-8", errors="replace") if response.body else ""
+
+        return {
+            "code": response.code,
+            "headers": dict(response.headers.get_all()),
+            "body": response_body
+        }
+
+    # noinspection PyMethodMayBeStatic
+    def stream(self, url, method="GET", body=None, headers=None, timeout=None, binary=False, max_size=None):
+        """
+        Makes a HTTP request, and returns an async iterator over the chunks of the response body
+        (strings, or ArrayBuffers if binary is true), so a large body could be processed as it's being received:
+
+        for await (const chunk of web.stream(url, "GET", null, null, 60, true))
+        {
+            ...
+        }
+
+        Fails (once the body is over) if the response had an error code, or the body is larger than max_size.
+        The response is not received further while js_web_stream_buffer_size bytes of it are waiting
+        to be taken, and breaking out of the loop aborts it.
+        """
+
+        request = WebAPI.__new_request__(method, url, body, headers, timeout)
+
+        max_body_size = options.js_web_max_stream_size
+        if isinstance(max_size, int) and 0 < max_size < max_body_size:
+            max_body_size = max_size
+
+        handler = PromiseContext.current.get()
+        stream = WebStream(request, max_body_size, options.js_web_stream_buffer_size, binary)
+        stream.start(handler)
+
+        return new(handler.context.glob.AsyncCursor, stream)
+
 
-            for future in new_futures:
-                future.set_result(body)
+class APICaches(object, metaclass=singleton.Singleton):
+    """
+    Caches of the API results, shared by every build on this node (and, through the key/value storage,
+    by every exec node)
+    """
 
-            del self.rc_cache[url]
+    def __init__(self):
+        application = Server.instance()
+
+        kv = getattr(application, "cache", None)
+        monitor = application.monitor_rate if application else None
+
+        self.config = TwoTierCache(
+            "config", kv=kv, ttl=options.js_api_cache_ttl, local_ttl=options.js_api_local_cache_ttl,
+            max_stale=options.js_api_cache_max_stale, monitor=monitor)
+        self.store = TwoTierCache(
+            "store", kv=kv, ttl=options.js_api_cache_ttl, local_ttl=options.js_api_local_cache_ttl,
+            max_stale=options.js_api_cache_max_stale, monitor=monitor)
+        self.web = HTTPResponseCache(
+            max_bytes=options.js_web_cache_max_bytes, max_entry_bytes=options.js_web_cache_max_entry_bytes)
+
+    def stats(self):
+        return {
+            "config": self.config.stats(),
+            "store": self.store.stats(),
+            "web": self.web.stats()
+        }
+
+
+def is_rejected(error):
+    """
+    Tells if a service has rejected a request as a whole (as an invalid one), so it has not been applied
+    at all, and it's safe to send (parts of) it again. Timeouts and server errors do not tell anything.
+    """
+    return 400 <= error.code < 500 and error.code not in (408, 429)
+
+
+async def send_messages(key, items, send):
+    """
+    Sends the messages of several requests (each item is a list of messages) with a single
+    `send(key, messages)` call. If the service has rejected them, each request is sent on its own,
+    so only the malformed ones fail. Otherwise (a timeout, for example) the messages might have been
+    delivered already, so nothing is sent again, and every request fails.
+    """
+    if len(items) > 1:
+        try:
+            return [await send(key, [message for messages in items for message in messages])] * len(items)
+        except APIError as e:
+            if not is_rejected(e):
+                raise
+
+    results = []
+    for messages in items:
+        try:
+            results.append(await send(key, messages))
+        except APIError as e:
+            results.append(e)
+    return results
+
+
+class APIBatches(object, metaclass=singleton.Singleton):
+    """
+    Requests to the services that have a bulk endpoint, collected across every build on this node
+    and sent together (see RequestBatcher)
+    """
+
+    def __init__(self):
+        window = options.js_api_batch_window / 1000.0
+        max_size = options.js_api_batch_max_size
+
+        self.messages = RequestBatcher(APIBatches.__send_messages__, window=window, max_size=max_size)
+        self.group_profiles = RequestBatcher(APIBatches.__update_group_profiles__, window=window, max_size=max_size)
+
+        # single messages (message.send) are queued for a while longer, to make bigger batches
+        self.message_queue = RequestBatcher(
+            APIBatches.__send_messages__,
+            window=options.js_message_queue_window / 1000.0,
+            max_size=options.js_message_queue_max_size)
+
+    def stats(self):
+        return {
+            "messages": self.messages.stats(),
+            "message_queue": self.message_queue.stats(),
+            "group_profiles": self.group_profiles.stats()
+        }
+
+    @staticmethod
+    async def __send_messages__(key, items):
+        return await send_messages(key, items, APIBatches.__send_message_batch__)
+
+    @staticmethod
+    async def __send_message_batch__(key, messages):
+        gamespace, sender, authoritative = key
+
+        await APIClient().request(
+            "message", "send_batch",
+            timeout=API_TIMEOUT,
+            gamespace=gamespace,
+            sender=sender,
+            messages=messages,
+            authoritative=authoritative)
+
+        return "OK"
 
-        return body
+    @staticmethod
+    async def __update_group_profiles__(key, items):
+        gamespace, path, merge = key
+        client = APIClient()
+
+        # the path is a tuple only to be a part of the key, the service gets it as it's been passed
+        if isinstance(path, tuple):
+            path = list(path)
+
+        async def update(group_id, profile):
+            return await client.request(
+                "social", "update_group_profile",
+                timeout=API_TIMEOUT,
+                gamespace=gamespace,
+                group_id=group_id,
+                profile=profile,
+                path=path,
+                merge=merge)
+
+        if len(items) == 1:
+            group_id, profile = items[0]
+            return [await update(group_id, profile)]
+
+        # the same group updated several times goes into separate rounds, so the updates apply in order
+        rounds = []
+        positions = []
+        for group_id, profile in items:
+            group_id = str(group_id)
+            for index, group_profiles in enumerate(rounds):
+                if group_id not in group_profiles:
+                    break
+            else:
+                index = len(rounds)
+                rounds.append({})
+            rounds[index][group_id] = profile
+            positions.append((index, group_id))
+
+        results = [None] * len(items)
+        failure = None
+
+        for index, group_profiles in enumerate(rounds):
+            members = [
+                (position, group_id)
+                for position, (round_index, group_id) in enumerate(positions)
+                if round_index == index
+            ]
+
+            # the updates that go after the failed ones are not sent at all
+            if failure is not None:
+                for position, group_id in members:
+                    results[position] = failure
+                continue
+
+            try:
+                response = await client.request(
+                    "social", "update_group_profiles",
+                    timeout=API_TIMEOUT,
+                    gamespace=gamespace,
+                    group_profiles=group_profiles,
+                    path=path,
+                    merge=merge)
+            except APIError as e:
+                if not is_rejected(e):
+                    # the round might have been applied, so nothing is sent again
+                    failure = e
+                    for position, group_id in members:
+                        results[position] = e
+                    continue
+
+                # a bulk update is rejected as a whole, so nothing has been applied: find out who's failed
+                for position, group_id in members:
+                    try:
+                        results[position] = await update(items[position][0], group_profiles[group_id])
+                    except APIError as e:
+                        results[position] = e
+                continue
+
+            for position, group_id in members:
+                try:
+                    results[position] = response[group_id]
+                except (KeyError, TypeError):
+                    # the update has been applied still, only the response is not what's expected
+                    results[position] = APIError(500, "Bad response for group {0}".format(group_id))
+
+        return results
 
 
 # noinspection PyUnusedLocal
@@ -95,25 +522,28 @@ class ConfigAPI(object):
 
         app_name = handler.env["application_name"]
         app_version = handler.env["application_version"]
+        gamespace = handler.env["gamespace"]
 
-        key = "config:" + str(app_name) + ":" + str(app_version)
-        cached = handler.get_cache(key)
-        if cached:
-            return cached
+        key = str(gamespace) + ":" + str(app_name) + ":" + str(app_version)
 
-        internal = Internal()
+        info = await APICaches().config.get(
+            key, ConfigAPI.__get_configuration__, gamespace, app_name, app_version, track=handler.track)
 
-        try:
-            info = await internal.request(
-                "config", "get_configuration",
-                timeout=API_TIMEOUT,
-                app_name=app_name,
-                app_version=app_version,
-                gamespace=handler.env["gamespace"])
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        return info
+
+    @staticmethod
+    async def __get_configuration__(gamespace, app_name, app_version):
+        client = APIClient()
+
+        info = await client.request(
+            "config", "get_configuration",
+            timeout=API_TIMEOUT,
+            hedge=True,
+            coalesce=True,
+            app_name=app_name,
+            app_version=app_version,
+            gamespace=gamespace)
 
-        handler.set_cache(key, info)
         return info
 
 
@@ -126,34 +556,36 @@ class StoreAPI(object):
         if not isinstance(name, str):
             raise APIError(400, "name should be a string")
 
-        key = "store:" + str(name)
-        cached = handler.get_cache(key)
-        if cached:
-            return cached
+        gamespace = handler.env["gamespace"]
+        key = str(gamespace) + ":" + name
+
+        config = await APICaches().store.get(key, StoreAPI.__get_store__, gamespace, name, track=handler.track)
+        return config
 
-        internal = Internal()
+    @staticmethod
+    async def __get_store__(gamespace, name):
+        client = APIClient()
 
-        try:
-            config = await internal.request(
-                "store", "get_store",
-                timeout=API_TIMEOUT,
-                gamespace=handler.env["gamespace"],
-                name=name)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        config = await client.request(
+            "store", "get_store",
+            timeout=API_TIMEOUT,
+            hedge=True,
+            coalesce=True,
+            gamespace=gamespace,
+            name=name)
 
-        handler.set_cache(key, config)
         return config
 
     @promise
     async def new_order(self, store, item, currency, amount, component, env=None, handler=None, *ignored):
 
-        internal = Internal()
+        client = APIClient()
 
         try:
-            result = await internal.request(
+            result = await client.request(
                 "store", "new_order",
                 timeout=API_TIMEOUT,
+                deadline=handler.deadline,
                 gamespace=handler.env["gamespace"],
                 account=handler.env["account"],
                 store=store,
@@ -162,45 +594,112 @@ class StoreAPI(object):
                 amount=amount,
                 component=component,
                 env=env)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        finally:
+            # the order might have given the account some currency or items already
+            handler.profile_changed()
 
         return result
 
     @promise
     async def update_order(self, order_id, handler=None, *ignored):
 
-        internal = Internal()
+        client = APIClient()
 
         try:
-            result = await internal.request(
+            result = await client.request(
                 "store", "update_order",
                 timeout=API_TIMEOUT,
+                deadline=handler.deadline,
                 gamespace=handler.env["gamespace"],
                 account=handler.env["account"],
                 order_id=order_id)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        finally:
+            # the order might have given the account some currency or items already
+            handler.profile_changed()
 
         return result
 
     @promise
     async def update_orders(self, handler=None, *ignored):
 
-        internal = Internal()
+        client = APIClient()
 
         try:
-            result = await internal.request(
+            result = await client.request(
                 "store", "update_orders",
                 timeout=API_TIMEOUT,
+                deadline=handler.deadline,
                 gamespace=handler.env["gamespace"],
                 account=handler.env["account"])
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        finally:
+            # the orders might have given the account some currency or items already
+            handler.profile_changed()
 
         return result
 
 
+# noinspection PyUnusedLocal
+class ProfileScan(object):
+    """
+    Pages over the results of a profile query, see ProfileAPI.scan.
+
+    This is not a streaming cursor: the profile service has no way to continue a query (the query
+    could only filter the profile fields, not the accounts), so at most `limit` results are fetched
+    in a single request upon the first page, and are only passed over to the script a page at a time.
+    """
+
+    def __init__(self, gamespace, query, page_size, limit):
+        self.gamespace = gamespace
+        self.query = query
+        self.page_size = page_size
+        self.limit = limit
+        self.results = None
+        self.closed = False
+
+    @promise
+    async def next(self, handler=None, *ignored):
+        if self.closed:
+            return None
+
+        if self.results is None:
+            client = APIClient()
+
+            results = await client.request(
+                "profile", "query_profiles",
+                timeout=API_TIMEOUT,
+                deadline=handler.deadline,
+                gamespace_id=self.gamespace,
+                query=self.query,
+                limit=self.limit)
+
+            if self.closed:
+                return None
+
+            self.results = [
+                {
+                    "account": str(account),
+                    "profile": result.get("profile")
+                }
+                for account, result in results.get("results", {}).items()
+            ]
+
+            # go backwards, so a page could be taken off the end
+            self.results.reverse()
+
+        if not self.results:
+            self.close()
+            return None
+
+        page = self.results[-self.page_size:]
+        del self.results[-self.page_size:]
+        page.reverse()
+        return page
+
+    def close(self):
+        self.closed = True
+        self.results = None
+
+
 # noinspection PyUnusedLocal
 class ProfileAPI(object):
 
@@ -210,17 +709,34 @@ class ProfileAPI(object):
         if not isinstance(path, str):
             raise APIError(400, "Path should be a string")
 
-        internal = Internal()
+        gamespace = handler.env["gamespace"]
+        account = handler.env["account"]
 
-        try:
-            profile = await internal.request(
-                "profile", "get_my_profile",
-                timeout=API_TIMEOUT,
-                gamespace_id=handler.env["gamespace"],
-                account_id=handler.env["account"],
-                path=path)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        # read own deferred updates
+        await ProfileWriter().flush(gamespace, account)
+
+        profile_cache = handler.profile_cache
+
+        if profile_cache is not None:
+            found, profile = profile_cache.get(path)
+            if found:
+                return profile
+
+        client = APIClient()
+
+        # a read already in progress might have been started before the call's own write was applied
+        profile = await client.request(
+            "profile", "get_my_profile",
+            timeout=API_TIMEOUT,
+            hedge=True,
+            deadline=handler.deadline,
+            coalesce=not handler.profile_written,
+            gamespace_id=gamespace,
+            account_id=account,
+            path=path)
+
+        if profile_cache is not None:
+            profile_cache.set(path, profile)
 
         return profile
 
@@ -234,40 +750,171 @@ class ProfileAPI(object):
         if not profile:
             profile = {}
 
-        internal = Internal()
+        gamespace = handler.env["gamespace"]
+        account = handler.env["account"]
 
-        try:
-            profile = await internal.request(
-                "profile", "update_profile",
-                timeout=API_TIMEOUT,
-                gamespace_id=handler.env["gamespace"],
-                account_id=handler.env["account"],
-                fields=profile,
-                path=path,
-                merge=merge)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        # deferred updates go first
+        await ProfileWriter().flush(gamespace, account)
+
+        handler.profile_written = True
+        client = APIClient()
+
+        profile = await client.request(
+            "profile", "update_profile",
+            timeout=API_TIMEOUT,
+            deadline=handler.deadline,
+            gamespace_id=gamespace,
+            account_id=account,
+            fields=profile,
+            path=path,
+            merge=merge)
 
         handler.set_cache(key, profile)
+
+        if handler.profile_cache is not None:
+            handler.profile_cache.set(path, profile)
+
         return profile
 
+    @promise
+    async def update_deferred(self, profile=None, path="", merge=True, handler=None, *ignored):
+        """
+        Same as update, but the update is sent to the profile service later on, merged with other updates
+        of the same path (see ProfileWriter). The update is complete by the time the call returns
+        (if the update has failed, so does the call). The updated profile is not returned.
+        """
+
+        if not isinstance(path, str):
+            raise APIError(400, "Path should be a string")
+
+        if not profile:
+            profile = {}
+
+        if not isinstance(profile, dict):
+            raise APIError(400, "Profile should be an object")
+
+        gamespace = handler.env["gamespace"]
+        account = handler.env["account"]
+
+        handler.profile_changed(path)
+
+        writer = ProfileWriter()
+        future = writer.update(gamespace, account, path, profile, merge=merge)
+        handler.defer(future, writer.flush, gamespace, account)
+
+    # noinspection PyMethodMayBeStatic
+    def invalidate(self, path=""):
+        """
+        Makes the session forget the profile it has cached (everything above and below the path),
+        for example, once the script knows the profile has been changed elsewhere
+        """
+
+        if not isinstance(path, str):
+            raise APIError(400, "Path should be a string")
+
+        handler = PromiseContext.current.get()
+        if handler and handler.profile_cache is not None:
+            handler.profile_cache.invalidate(path)
+
+    @promise
+    async def get_many(self, accounts, path="", private=False, handler=None, *ignored):
+        """
+        Returns profiles of several accounts at once, as an object {account: profile}.
+        Private profiles are returned only if 'private' is true, otherwise only the fields
+        accessible by others are.
+        """
+
+        if not isinstance(path, str):
+            raise APIError(400, "Path should be a string")
+
+        try:
+            accounts = validate_value(accounts, "json_list_of_ints")
+        except ValidationError:
+            raise APIError(400, "Accounts should be a list of account IDs")
+
+        keys = split_path(path)
+        accounts = list(set(accounts))
+        gamespace = handler.env["gamespace"]
+
+        if not accounts:
+            return {}
+
+        client = APIClient()
+        limit = Semaphore(options.js_profile_get_many_parallel)
+
+        async def fetch(chunk):
+            async with limit:
+                return await client.request(
+                    "profile", "mass_profiles",
+                    timeout=API_TIMEOUT,
+                    deadline=handler.deadline,
+                    action="get_private" if private else "get_public",
+                    gamespace=gamespace,
+                    accounts=chunk,
+                    profile_fields=keys[:1])
+
+        chunks = await multi([
+            fetch(accounts[i:i + MASS_PROFILES_LIMIT])
+            for i in range(0, len(accounts), MASS_PROFILES_LIMIT)
+        ])
+
+        result = {}
+
+        for profiles in chunks:
+            for account, profile in profiles.items():
+                for key in keys:
+                    if not isinstance(profile, dict):
+                        profile = None
+                        break
+                    profile = profile.get(key)
+                result[str(account)] = profile
+
+        return result
+
+    # noinspection PyMethodMayBeStatic
+    def scan(self, query, page_size=100, limit=None):
+        """
+        Same as query, but returns an async iterator over the results, that are passed over to the script
+        page by page, instead of all at once:
+
+        for await (const result of profile.scan({"level": {"@func": ">", "@value": 10}}))
+        {
+            // result.account, result.profile
+        }
+
+        The results are still fetched in one go (see ProfileScan), so limit is capped
+        by js_profile_scan_limit, the same as the default limit of query.
+        """
+
+        if not validate_value(query, "json_dict"):
+            raise APIError(400, "Query should be a JSON object")
+
+        if not isinstance(page_size, int) or page_size <= 0:
+            raise APIError(400, "Page size should be a positive number")
+
+        handler = PromiseContext.current.get()
+        max_limit = options.js_profile_scan_limit
+        limit = min(limit, max_limit) if isinstance(limit, int) and limit > 0 else max_limit
+
+        cursor = ProfileScan(handler.env["gamespace"], query, page_size, limit)
+        return new(handler.context.glob.AsyncCursor, cursor)
+
     @promise
     async def query(self, query, limit=1000, handler=None, *ignored):
 
         if not validate_value(query, "json_dict"):
             raise APIError(400, "Query should be a JSON object")
 
-        internal = Internal()
+        client = APIClient()
 
-        try:
-            results = await internal.request(
-                "profile", "query_profiles",
-                timeout=API_TIMEOUT,
-                gamespace_id=handler.env["gamespace"],
-                query=query,
-                limit=limit)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        results = await client.request(
+            "profile", "query_profiles",
+            timeout=API_TIMEOUT,
+            deadline=handler.deadline,
+            coalesce=True,
+            gamespace_id=handler.env["gamespace"],
+            query=query,
+            limit=limit)
 
         return results
 
@@ -277,47 +924,42 @@ class SocialAPI(object):
 
     @promise
     async def acquire_name(self, kind, name, handler=None, *ignored):
-        internal = Internal()
+        client = APIClient()
 
-        try:
-            profile = await internal.request(
-                "social", "acquire_name",
-                gamespace=handler.env["gamespace"],
-                account=handler.env["account"],
-                kind=kind,
-                name=name)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        profile = await client.request(
+            "social", "acquire_name",
+            deadline=handler.deadline,
+            gamespace=handler.env["gamespace"],
+            account=handler.env["account"],
+            kind=kind,
+            name=name)
 
         return profile
 
     @promise
     async def check_name(self, kind, name, handler=None, *ignored):
-        internal = Internal()
+        client = APIClient()
 
-        try:
-            account_id = await internal.request(
-                "social", "check_name",
-                gamespace=handler.env["gamespace"],
-                kind=kind,
-                name=name)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        account_id = await client.request(
+            "social", "check_name",
+            deadline=handler.deadline,
+            coalesce=True,
+            gamespace=handler.env["gamespace"],
+            kind=kind,
+            name=name)
 
         return account_id
 
     @promise
     async def release_name(self, kind, handler=None, *ignored):
-        internal = Internal()
+        client = APIClient()
 
-        try:
-            released = await internal.request(
-                "social", "release_name",
-                gamespace=handler.env["gamespace"],
-                account=handler.env["account"],
-                kind=kind)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        released = await client.request(
+            "social", "release_name",
+            deadline=handler.deadline,
+            gamespace=handler.env["gamespace"],
+            account=handler.env["account"],
+            kind=kind)
 
         return released
 
@@ -326,19 +968,8 @@ class SocialAPI(object):
         if path and not isinstance(path, (list, tuple)):
             raise APIError(400, "Path should be a list/tuple")
 
-        internal = Internal()
-
-        try:
-            profile = await internal.request(
-                "social", "update_group_profile",
-                timeout=API_TIMEOUT,
-                gamespace=handler.env["gamespace"],
-                group_id=group_id,
-                profile=profile,
-                path=path,
-                merge=merge)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        key = (handler.env["gamespace"], tuple(path) if isinstance(path, (list, tuple)) else path, bool(merge))
+        profile = await APIBatches().group_profiles.add(key, (group_id, profile))
 
         return profile
 
@@ -350,19 +981,17 @@ class SocialAPI(object):
         if path and not isinstance(path, (list, tuple)):
             raise APIError(400, "Path should be a list/tuple")
 
-        internal = Internal()
+        client = APIClient()
 
-        try:
-            profile = await internal.request(
-                "social", "update_group_profiles",
-                timeout=API_TIMEOUT,
-                gamespace=handler.env["gamespace"],
-                group_profiles=group_profiles,
-                path=path or [],
-                merge=merge,
-                synced=synced)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        profile = await client.request(
+            "social", "update_group_profiles",
+            timeout=API_TIMEOUT,
+            deadline=handler.deadline,
+            gamespace=handler.env["gamespace"],
+            group_profiles=group_profiles,
+            path=path or [],
+            merge=merge,
+            synced=synced)
 
         return profile
 
@@ -373,19 +1002,37 @@ class MessageAPI(object):
     @promise
     async def send_batch(self, sender, messages, authoritative=True, handler=None, *ignored):
 
-        internal = Internal()
+        if not isinstance(messages, list):
+            raise APIError(400, "Messages should be a list")
 
-        try:
-            await internal.request(
-                "message", "send_batch",
-                timeout=API_TIMEOUT,
-                gamespace=handler.env["gamespace"],
-                sender=sender,
-                messages=messages,
-                authoritative=authoritative)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
-        return "OK"
+        key = (handler.env["gamespace"], sender, bool(authoritative))
+        return await APIBatches().messages.add(key, messages)
+
+    @promise
+    async def send(self, sender, recipient_class, recipient_key, message_type, payload,
+                   flags=None, authoritative=True, handler=None, *ignored):
+        """
+        Sends a single message. Messages are queued on this node for a short while, and are sent together
+        with other messages of the same sender, the promise is resolved once the message is sent.
+        If the promise is rejected because of a timeout, the message might have been delivered still.
+        """
+
+        if not isinstance(payload, dict):
+            raise APIError(400, "Payload should be an object")
+
+        if flags is not None and not isinstance(flags, list):
+            raise APIError(400, "Flags should be a list")
+
+        message = {
+            "recipient_class": str(recipient_class),
+            "recipient_key": str(recipient_key),
+            "message_type": str(message_type),
+            "payload": payload,
+            "flags": flags or []
+        }
+
+        key = (handler.env["gamespace"], sender, bool(authoritative))
+        return await APIBatches().message_queue.add(key, [message])
 
 
 # noinspection PyUnusedLocal
@@ -394,17 +1041,19 @@ class PromoAPI(object):
     @promise
     async def use_code(self, key, handler=None, *ignored):
 
-        internal = Internal()
+        client = APIClient()
 
         try:
-            result = await internal.request(
+            result = await client.request(
                 "promo", "use_code",
                 timeout=API_TIMEOUT,
+                deadline=handler.deadline,
                 gamespace=handler.env["gamespace"],
                 account=handler.env["account"],
                 key=key)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        finally:
+            # the code might have given the account something already
+            handler.profile_changed()
 
         try:
             result = result["result"]
@@ -417,11 +1066,12 @@ class PromoAPI(object):
 class EventAPI(object):
     @promise
     async def update_event_profile(self, event_id, profile, path=None, merge=True, handler=None):
-        internal = Internal()
+        client = APIClient()
 
         try:
-            events = await internal.request(
+            events = await client.request(
                 "event", "update_event_profile",
+                deadline=handler.deadline,
                 event_id=event_id,
                 profile=profile,
                 path=path,
@@ -429,25 +1079,26 @@ class EventAPI(object):
                 timeout=API_TIMEOUT,
                 gamespace=handler.env["gamespace"],
                 account=handler.env["account"])
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        finally:
+            # a contribution might have rewarded the account already
+            handler.profile_changed()
 
         return events
 
     @promise
     async def list(self, extra_start_time=0, extra_end_time=0, handler=None):
-        internal = Internal()
-
-        try:
-            events = await internal.request(
-                "event", "get_list",
-                timeout=API_TIMEOUT,
-                gamespace=handler.env["gamespace"],
-                account=handler.env["account"],
-                extra_start_time=extra_start_time,
-                extra_end_time=extra_end_time)
-        except InternalError as e:
-            raise APIError(e.code, e.body)
+        client = APIClient()
+
+        events = await client.request(
+            "event", "get_list",
+            timeout=API_TIMEOUT,
+            hedge=True,
+            deadline=handler.deadline,
+            coalesce=True,
+            gamespace=handler.env["gamespace"],
+            account=handler.env["account"],
+            extra_start_time=extra_start_time,
+            extra_end_time=extra_end_time)
 
         return events
 
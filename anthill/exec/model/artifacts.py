@@ -0,0 +1,59 @@
+
+import hashlib
+import logging
+import ujson
+
+
+class BuildArtifacts(object):
+    """
+    Keeps bundled sources of the builds in the shared key/value storage, so every exec node can load
+    a build without running git. Artifacts are produced (and validated to compile) once a version is
+    switched to a commit, see JavascriptBuildsModel.publish_build.
+
+    A bundle is a list of [filename, source] pairs, in the order the files should be compiled.
+    """
+
+    def __init__(self, kv, ttl=604800):
+        self.kv = kv
+        self.ttl = ttl
+
+    @staticmethod
+    def __key__(repository_url, commit):
+        return "artifact:" + hashlib.sha1(str(repository_url).encode("utf-8")).hexdigest() + ":" + str(commit)
+
+    async def get(self, repository_url, commit):
+        """
+        Returns a bundle, or None if there is no such artifact (or the storage is not reachable)
+        """
+        if self.kv is None:
+            return None
+
+        key = BuildArtifacts.__key__(repository_url, commit)
+
+        try:
+            async with self.kv.acquire() as db:
+                data = await db.get(key)
+                if data is None:
+                    return None
+                # the artifact is in use, keep it for a while
+                await db.expire(key, self.ttl)
+        except Exception:
+            logging.exception("Failed to fetch build artifact {0}".format(key))
+            return None
+
+        try:
+            return ujson.loads(data)["files"]
+        except (KeyError, ValueError):
+            logging.error("Build artifact {0} is corrupted".format(key))
+            return None
+
+    async def put(self, repository_url, commit, bundle):
+        if self.kv is None:
+            return
+
+        key = BuildArtifacts.__key__(repository_url, commit)
+
+        async with self.kv.acquire() as db:
+            await db.setex(key, self.ttl, ujson.dumps({"files": bundle}))
+
+        logging.info("Published build artifact {0} ({1} files)".format(key, len(bundle)))
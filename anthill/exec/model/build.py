@@ -1,18 +1,21 @@
 import os
 
-from tornado.gen import TimeoutError, with_timeout, IOLoop
+from tornado.gen import IOLoop
 from tornado.ioloop import PeriodicCallback
 # noinspection PyUnresolvedReferences
 from v8py import JSException, JSPromise, Context, new, JavaScriptTerminated, Script
 
 from . api import expose
 from . session import JavascriptSession, JavascriptSessionError
-from . util import APIError, PromiseContext, JavascriptCallHandler, JavascriptExecutionError, JSFuture
+from . repository import SharedSourceCodeRoot, GitOperationScheduler
+from . artifacts import BuildArtifacts
+from . cache import SingleFlight
+from . util import PromiseContext, JavascriptCallHandler, JavascriptExecutionError
+from . pipeline import CallPipeline, JavascriptCall
 from . import stdlib
 
 from anthill.common.model import Model
-from anthill.common.access import InternalError
-from anthill.common.source import SourceCodeRoot, SourceCommitAdapter, SourceProjectAdapter
+from anthill.common.source import SourceCommitAdapter, SourceProjectAdapter
 from anthill.common.source import SourceCodeError, ServerCodeAdapter
 from anthill.common.validate import validate
 
@@ -20,8 +23,8 @@ from anthill.common.validate import validate
 from expiringdict import ExpiringDict
 
 from anthill.common.options import options
-import datetime
 import logging
+import time
 from .. import options as _opts
 
 
@@ -42,8 +45,25 @@ class NoSuchClass(Exception):
     pass
 
 
+def bundle_sources(source_path):
+    """
+    Reads the javascript files of a checked out build as a list of [filename, source] pairs
+    """
+    bundle = []
+
+    for file_name in os.listdir(source_path):
+        if not file_name.endswith(".js"):
+            continue
+
+        with open(os.path.join(source_path, file_name), 'r') as f:
+            bundle.append([str(file_name), f.read()])
+
+    return bundle
+
+
 class JavascriptBuild(object):
-    def __init__(self, build_id=None, model=None, source_path=None, autorelease_time=30000, is_server=False):
+    def __init__(self, build_id=None, model=None, source_path=None, autorelease_time=30000, is_server=False,
+                 bundle=None):
         self.build_id = build_id
         self.model = model
         self.context = Context()
@@ -64,16 +84,18 @@ class JavascriptBuild(object):
             raise JavascriptBuildError(500, str(e))
 
         if source_path:
-            for file_name in os.listdir(source_path):
-                if not file_name.endswith(".js"):
-                    continue
+            try:
+                bundle = bundle_sources(source_path)
+            except OSError as e:
+                raise JavascriptBuildError(500, str(e))
 
-                logging.info("Compiling file {0}".format(os.path.join(source_path, file_name)))
+        if bundle:
+            for file_name, source in bundle:
+                logging.info("Compiling file {0}".format(file_name))
 
                 try:
-                    with open(os.path.join(source_path, file_name), 'r') as f:
-                        script = Script(source=f.read(), filename=str(file_name))
-                        self.context.eval(script)
+                    script = Script(source=source, filename=str(file_name))
+                    self.context.eval(script)
                 except Exception as e:
                     logging.exception("Error while compiling")
                     raise JavascriptBuildError(500, str(e))
@@ -116,7 +138,7 @@ class JavascriptBuild(object):
                                         debug=debug, promise_type=self.promise_type)
         if log:
             handler.log = log
-        PromiseContext.current = handler
+        token = PromiseContext.current.set(handler)
 
         try:
             instance = new(clazz, args, env)
@@ -124,6 +146,9 @@ class JavascriptBuild(object):
             raise JavascriptSessionError(500, "Failed to open session: TypeError while construction")
         except JSException as e:
             raise JavascriptSessionError(500, "Failed to open session: " + str(e))
+        finally:
+            # whatever runs later on behalf of the call, runs in a context of its own
+            PromiseContext.current.reset(token)
 
         # declare some usage, session will release it using 'session_released' call
         self.add_ref()
@@ -150,48 +175,15 @@ class JavascriptBuild(object):
         if not getattr(method, "allow_call", False):
             raise NoSuchMethod()
 
-        handler = JavascriptCallHandler(None, env, self.context, promise_type=self.promise_type)
-        PromiseContext.current = handler
+        handler = JavascriptCallHandler(None, env, self.context, promise_type=self.promise_type,
+                                        deadline=time.time() + call_timeout)
 
         # declare some usage until this call is finished
         self.add_ref()
 
         try:
-            try:
-                future = self.context.async_call(method, (args,), JSFuture)
-            except JSException as e:
-                value = e.value
-                if hasattr(value, "code"):
-                    if hasattr(value, "stack"):
-                        raise JavascriptExecutionError(value.code, value.message, stack=str(value.stack))
-                    else:
-                        raise JavascriptExecutionError(value.code, value.message)
-                if hasattr(e, "stack"):
-                    raise JavascriptExecutionError(500, str(e), stack=str(e.stack))
-                raise JavascriptExecutionError(500, str(e))
-            except APIError as e:
-                raise JavascriptExecutionError(e.code, e.message)
-            except InternalError as e:
-                raise JavascriptExecutionError(
-                    e.code, "Internal error: " + e.body)
-            except JavaScriptTerminated:
-                raise JavascriptExecutionError(
-                    408, "Evaluation process timeout: function shouldn't be "
-                         "blocking and should rely on async methods instead.")
-            except Exception as e:
-                raise JavascriptExecutionError(500, str(e))
-
-            if future.done():
-                return future.result()
-
-            try:
-                result = await with_timeout(datetime.timedelta(seconds=call_timeout), future)
-            except TimeoutError:
-                raise APIError(408, "Total function '{0}' call timeout ({1})".format(
-                    method_name, call_timeout))
-            else:
-                return result
-
+            return await CallPipeline().invoke(
+                JavascriptCall.FUNCTION, self.context, method, method_name, args, handler, call_timeout)
         finally:
             del handler.context
             del handler
@@ -229,9 +221,12 @@ class JavascriptBuildsModel(Model):
 
     SERVER_PROJECT_NAME = "server"
 
-    def __init__(self, root_dir, sources):
+    def __init__(self, root_dir, sources, cache=None):
         self.sources = sources
-        self.root = SourceCodeRoot(root_dir)
+        self.artifacts = BuildArtifacts(cache, ttl=options.js_build_artifact_ttl)
+        self.flights = SingleFlight()
+        self.git = GitOperationScheduler(options.js_git_max_parallel_operations)
+        self.root = SharedSourceCodeRoot(root_dir, scheduler=self.git)
         self.builds = {}
 
     @staticmethod
@@ -245,28 +240,52 @@ class JavascriptBuildsModel(Model):
     def validate_repository_url(self, url, ssh_private_key=None):
         return self.root.validate_repository_url(url, ssh_private_key)
 
-    @validate(source=ServerCodeAdapter)
-    async def get_server_build(self, source):
-
-        build_id = JavascriptBuildsModel.__get_server_build_id__(source)
-        build = self.builds.get(build_id, None)
-        if build:
-            return build
-
+    async def __checkout__(self, project, commit):
         try:
-            project = self.root.project(source.gamespace_id, JavascriptBuildsModel.SERVER_PROJECT_NAME,
-                                        source.repository_url, source.repository_branch,
-                                        source.ssh_private_key)
             await project.init()
-            source_build = project.build(source.repository_commit)
+            source_build = project.build(commit)
             await source_build.init()
         except SourceCodeError as e:
             raise JavascriptBuildError(e.code, e.message)
 
-        build = JavascriptBuild(build_id, self, source_build.build_dir, is_server=True)
+        return source_build
+
+    async def __load_build__(self, build_id, project_name, source, is_server=False):
+        build = self.builds.get(build_id, None)
+        if build:
+            return build
+
+        # a precompiled artifact lets to skip git completely
+        bundle = await self.artifacts.get(source.repository_url, source.repository_commit)
+
+        if bundle is None:
+            try:
+                project = self.root.project(source.gamespace_id, project_name,
+                                            source.repository_url, source.repository_branch,
+                                            source.ssh_private_key)
+            except SourceCodeError as e:
+                raise JavascriptBuildError(e.code, e.message)
+
+            source_build = await self.__checkout__(project, source.repository_commit)
+            build = JavascriptBuild(build_id, self, source_build.build_dir, is_server=is_server)
+        else:
+            build = JavascriptBuild(build_id, self, bundle=bundle, is_server=is_server)
+
         self.builds[build_id] = build
         return build
 
+    @validate(source=ServerCodeAdapter)
+    async def get_server_build(self, source):
+
+        build_id = JavascriptBuildsModel.__get_server_build_id__(source)
+        build = self.builds.get(build_id, None)
+        if build:
+            return build
+
+        return await self.flights.run(
+            build_id, self.__load_build__, build_id,
+            JavascriptBuildsModel.SERVER_PROJECT_NAME, source, is_server=True)
+
     @validate(source=SourceCommitAdapter)
     async def get_build(self, source):
 
@@ -275,33 +294,52 @@ class JavascriptBuildsModel(Model):
         if build:
             return build
 
+        return await self.flights.run(build_id, self.__load_build__, build_id, source.name, source)
+
+    async def __publish__(self, project, repository_url, commit, is_server=False):
+        source_build = await self.__checkout__(project, commit)
+
         try:
-            project = self.root.project(source.gamespace_id, source.name,
-                                        source.repository_url, source.repository_branch,
-                                        source.ssh_private_key)
-            await project.init()
-            source_build = project.build(source.repository_commit)
-            await source_build.init()
-        except SourceCodeError as e:
-            raise JavascriptBuildError(e.code, e.message)
+            bundle = bundle_sources(source_build.build_dir)
+        except OSError as e:
+            raise JavascriptBuildError(500, str(e))
 
-        build = JavascriptBuild(build_id, self, source_build.build_dir)
-        self.builds[build_id] = build
-        return build
+        # make sure the bundle actually compiles before letting anybody to use it
+        build = JavascriptBuild(bundle=bundle, is_server=is_server)
+        await build.release()
+
+        # the artifact is only a shortcut, without it the nodes build from their own checkouts
+        try:
+            await self.artifacts.put(repository_url, commit, bundle)
+        except Exception:
+            logging.exception("Failed to publish build artifact for commit {0}".format(commit))
+
+    @validate(project_settings=SourceProjectAdapter, commit="str_name")
+    async def publish_build(self, project_settings, commit):
+        """
+        Checks out the commit, makes sure it compiles, and publishes the bundled sources, so exec nodes
+        could load the build without running git and the compiler on their own checkouts.
+        Should be called before a version is switched to the commit.
+
+        Raises JavascriptBuildError only if the commit cannot be checked out or does not compile,
+        a failure to store the artifact is logged, and the nodes fall back to building it themselves.
+        """
+        project = self.get_project(project_settings)
+        await self.__publish__(project, project_settings.repository_url, commit)
+
+    @validate(project_settings=ServerCodeAdapter, commit="str_name")
+    async def publish_server_build(self, project_settings, commit):
+        """
+        Same as publish_build, but for the Server Code
+        """
+        project = self.get_server_project(project_settings)
+        await self.__publish__(project, project_settings.repository_url, commit, is_server=True)
 
     @validate(project_settings=SourceProjectAdapter, commit="str_name")
     async def new_build_by_commit(self, project_settings, commit):
 
-        try:
-            project = self.root.project(
-                project_settings.gamespace_id, project_settings.name,
-                project_settings.repository_url, project_settings.repository_branch,
-                project_settings.ssh_private_key)
-            await project.init()
-            source_build = project.build(commit)
-            await source_build.init()
-        except SourceCodeError as e:
-            raise JavascriptBuildError(e.code, e.message)
+        project = self.get_project(project_settings)
+        source_build = await self.__checkout__(project, commit)
 
         build = JavascriptBuild(None, self, source_build.build_dir)
         return build
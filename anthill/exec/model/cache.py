@@ -0,0 +1,426 @@
+
+from expiringdict import ExpiringDict
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict
+
+import asyncio
+import logging
+import time
+import ujson
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share the same key: the first caller actually runs the coroutine,
+    everyone else who arrives while it is still in progress awaits the very same result (or exception).
+
+    flights = SingleFlight()
+    result = await flights.run("config:" + app_name, fetch_config, app_name)
+
+    The coroutine runs as a task on its own, so if one of the callers gets cancelled, the rest still
+    get the result.
+    """
+
+    def __init__(self):
+        self.rc_cache = {}
+
+    def __contains__(self, key):
+        return key in self.rc_cache
+
+    async def run(self, key, method, *args, **kwargs):
+        return await asyncio.shield(self.start(key, method, *args, **kwargs))
+
+    def start(self, key, method, *args, **kwargs):
+        """
+        Same as run, but does not wait: returns the flight (a Future) the key shares
+        """
+        flight = self.rc_cache.get(key, None)
+
+        if flight is None:
+            flight = asyncio.ensure_future(self.__run__(key, method, args, kwargs))
+            self.rc_cache[key] = flight
+
+        return flight
+
+    async def __run__(self, key, method, args, kwargs):
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            del self.rc_cache[key]
+
+
+class ExpiringCache(object):
+    """
+    A process-local cache with a time-to-live for every entry. A missing (or expired) value is resolved
+    with a coroutine passed to `get`, and concurrent lookups of the same key share a single resolve call.
+
+    Falsy values (empty dicts and such) are cached as well. None (nothing has been found) is cached for
+    `negative_ttl` seconds only, or not at all if it's 0, so things that appear later are picked up soon.
+
+    """
+
+    def __init__(self, max_len=1024, ttl=60, negative_ttl=0):
+        self.entries = ExpiringDict(max_len=max_len, max_age_seconds=ttl)
+        self.missing = ExpiringDict(max_len=max_len, max_age_seconds=negative_ttl) if negative_ttl > 0 else None
+        self.flights = SingleFlight()
+        self.generation = 0
+
+    async def get(self, key, resolve, *args, **kwargs):
+        try:
+            return self.entries[key]
+        except KeyError:
+            pass
+
+        if self.missing is not None and key in self.missing:
+            return None
+
+        return await self.flights.run(key, self.__resolve__, key, resolve, *args, **kwargs)
+
+    async def __resolve__(self, key, resolve, *args, **kwargs):
+        generation = self.generation
+        value = await resolve(*args, **kwargs)
+
+        # the cache has been invalidated while we were resolving, so the value might be stale already
+        if generation == self.generation:
+            if value is not None:
+                self.entries[key] = value
+            elif self.missing is not None:
+                self.missing[key] = True
+
+        return value
+
+    def invalidate(self, key):
+        self.generation += 1
+        self.entries.pop(key, None)
+        if self.missing is not None:
+            self.missing.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        if self.missing is not None:
+            self.missing.clear()
+
+
+class CacheEntry(object):
+    def __init__(self, value, fetched_at, loaded_at=None):
+        self.value = value
+        # when the value was resolved from its origin
+        self.fetched_at = fetched_at
+        # when the value was put into the in-process cache
+        self.loaded_at = loaded_at
+
+    def dump(self):
+        return {
+            "v": self.value,
+            "t": self.fetched_at
+        }
+
+
+class TwoTierCache(object):
+    """
+    A cache of two tiers: an in-process one (L1), shared by every build on this node, and the shared
+    key/value storage (L2), shared by every node. A value missing in both is resolved with a coroutine passed
+    to `get`, and concurrent lookups of the same key on this node share a single refresh.
+
+    Every value has a soft and a hard time-to-live:
+
+    * a value younger than `ttl` is fresh (on this node, it is checked against L2 every `local_ttl` seconds);
+    * an older one is stale: it is returned immediately, while a single refresh runs in the background;
+    * a value older than `max_stale` is never returned, the caller waits for a refresh instead.
+
+    Falsy values (None, empty dicts) are cached as well.
+
+    The background refresh is passed to `track` (see JavascriptCallHandler.track), so it's cancelled
+    along with the call that has triggered it. The shared lookup itself goes on for everyone else.
+
+    """
+
+    def __init__(self, name, kv=None, max_len=2048, ttl=60, local_ttl=10, max_stale=300, monitor=None):
+        self.name = name
+        self.kv = kv
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.max_stale = max(ttl, max_stale)
+        self.local = ExpiringDict(max_len=max_len, max_age_seconds=self.max_stale)
+        self.flights = SingleFlight()
+        self.monitor = monitor
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+
+    def __key__(self, key):
+        return "api_cache:" + self.name + ":" + key
+
+    def __hit__(self, name_property):
+        if self.monitor:
+            self.monitor("api_cache", name_property, cache=self.name)
+
+    def stats(self):
+        total = self.hits + self.stale_hits + self.l2_hits + self.misses
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "hit_ratio": ((self.hits + self.stale_hits + self.l2_hits) / total) if total else 0
+        }
+
+    async def get(self, key, resolve, *args, track=None, **kwargs):
+        now = time.time()
+        entry = self.local.get(key)
+
+        if entry is not None and now - entry.fetched_at < self.max_stale:
+            if now - entry.loaded_at < self.local_ttl and now - entry.fetched_at < self.ttl:
+                self.hits += 1
+                self.__hit__("hit")
+            else:
+                self.stale_hits += 1
+                self.__hit__("stale_hit")
+                self.__revalidate__(key, resolve, args, kwargs, track)
+
+            return entry.value
+
+        return await self.flights.run(key, self.__load__, key, resolve, args, kwargs)
+
+    def __revalidate__(self, key, resolve, args, kwargs, track):
+        if key in self.flights:
+            return
+
+        flight = self.flights.start(key, self.__load__, key, resolve, args, kwargs)
+        task = asyncio.ensure_future(self.__refresh__(key, flight))
+        if track is not None:
+            track(task)
+
+    @staticmethod
+    async def __refresh__(key, flight):
+        try:
+            await asyncio.shield(flight)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the stale value is served until it gets too old
+            logging.warning("Failed to refresh '{0}' in the cache: {1}".format(key, str(e)))
+
+    async def __load__(self, key, resolve, args, kwargs):
+        entry = await self.__get_shared__(key)
+
+        if entry is not None and time.time() - entry.fetched_at < self.ttl:
+            self.l2_hits += 1
+            self.__hit__("l2_hit")
+        else:
+            self.misses += 1
+            self.__hit__("miss")
+
+            fetched_at = time.time()
+            value = await resolve(*args, **kwargs)
+            entry = CacheEntry(value, fetched_at)
+
+            await self.__set_shared__(key, entry)
+
+        entry.loaded_at = time.time()
+        self.local[key] = entry
+        return entry.value
+
+    async def __get_shared__(self, key):
+        if self.kv is None:
+            return None
+
+        try:
+            async with self.kv.acquire() as db:
+                data = await db.get(self.__key__(key))
+        except Exception:
+            logging.exception("Failed to look up '{0}' in the shared cache".format(key))
+            return None
+
+        if data is None:
+            return None
+
+        try:
+            data = ujson.loads(data)
+            return CacheEntry(data["v"], float(data["t"]))
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    async def __set_shared__(self, key, entry):
+        if self.kv is None:
+            return
+
+        try:
+            async with self.kv.acquire() as db:
+                await db.setex(self.__key__(key), self.max_stale, ujson.dumps(entry.dump()))
+        except Exception:
+            logging.exception("Failed to store '{0}' in the shared cache".format(key))
+
+    def invalidate(self, key):
+        self.local.pop(key, None)
+
+
+class HTTPCacheEntry(object):
+    def __init__(self, body, expires_at, etag=None, last_modified=None):
+        self.body = body
+        self.expires_at = expires_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    def fresh(self):
+        return time.time() < self.expires_at
+
+    def validators(self):
+        """
+        Headers to send along with a request, so the server could tell the cached response is still valid
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class HTTPResponseCache(object):
+    """
+    A least recently used cache of HTTP responses, limited by the total size of the bodies.
+
+    Follows the response headers:
+
+    * Cache-Control: no-store (or private) responses are not cached at all;
+    * Cache-Control: max-age (or Expires) defines how long a response is fresh;
+    * Cache-Control: no-cache responses (and the ones that have expired) are revalidated with the server,
+      if they have an ETag or Last-Modified (see HTTPCacheEntry.validators).
+
+    """
+
+    def __init__(self, max_bytes=16777216, max_entry_bytes=1048576):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url, headers=None):
+        """
+        Responses to the same url could differ depending on the request headers, so they are the part of the key
+        """
+        if not headers:
+            return url
+        return url + "\n" + "\n".join(
+            name + ":" + value
+            for name, value in sorted((str(name).lower(), str(value)) for name, value in headers.items()))
+
+    @staticmethod
+    def __parse_cache_control__(value):
+        directives = {}
+        for directive in value.split(","):
+            directive = directive.strip().lower()
+            if not directive:
+                continue
+            name, _, argument = directive.partition("=")
+            directives[name.strip()] = argument.strip().strip('"')
+        return directives
+
+    @staticmethod
+    def __expires_at__(headers):
+        """
+        Returns the time the response expires at, or None if it should not be cached
+        """
+        cache_control = HTTPResponseCache.__parse_cache_control__(headers.get("Cache-Control", ""))
+
+        if "no-store" in cache_control or "private" in cache_control:
+            return None
+
+        now = time.time()
+
+        if "no-cache" in cache_control:
+            return now
+
+        max_age = cache_control.get("s-maxage", cache_control.get("max-age"))
+        if max_age is not None:
+            try:
+                return now + max(0, int(max_age))
+            except ValueError:
+                return now
+
+        expires = headers.get("Expires")
+        if expires:
+            try:
+                return parsedate_to_datetime(expires).timestamp()
+            except (TypeError, ValueError):
+                # an invalid date means the response has expired already
+                return now
+
+        return now
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses
+        }
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, headers, body):
+        """
+        Stores a response (if it's allowed to), returns the entry stored, or None
+        """
+        self.remove(key)
+
+        expires_at = HTTPResponseCache.__expires_at__(headers)
+        if expires_at is None:
+            return None
+
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+
+        # an expired response is of any use only if it could be revalidated
+        if expires_at <= time.time() and not etag and not last_modified:
+            return None
+
+        if body is None or len(body) > self.max_entry_bytes:
+            return None
+
+        entry = HTTPCacheEntry(body, expires_at, etag=etag, last_modified=last_modified)
+        self.entries[key] = entry
+        self.size += entry.size
+
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+        return entry
+
+    def revalidated(self, key, entry, headers):
+        """
+        The server has confirmed (with 304 Not Modified) the entry is still valid
+        """
+        expires_at = HTTPResponseCache.__expires_at__(headers)
+
+        if expires_at is None:
+            self.remove(key)
+            return
+
+        entry.expires_at = expires_at
+        entry.etag = headers.get("ETag", entry.etag)
+        entry.last_modified = headers.get("Last-Modified", entry.last_modified)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
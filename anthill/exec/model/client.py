@@ -0,0 +1,533 @@
+
+from tornado.locks import Semaphore
+from tornado.ioloop import IOLoop
+from tornado.gen import Future, with_timeout, TimeoutError
+
+from anthill.common.internal import Internal, InternalError
+from anthill.common.jsonrpc import JSONRPC_TIMEOUT
+from anthill.common.server import Server
+from anthill.common.options import options
+from anthill.common import singleton
+
+from . util import APIError
+from . cache import SingleFlight
+from .. import options as _opts
+
+from collections import deque
+
+import asyncio
+import datetime
+import logging
+import time
+import ujson
+
+
+class ServiceStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # amount of requests that had to wait because of the per-service limit
+        self.throttled = 0
+        # amount of requests that have been served with a result of an identical request in progress
+        self.coalesced = 0
+        # amount of requests that have not been sent since the caller's deadline has passed already
+        self.shed = 0
+        # amount of requests that have been failed right away because the circuit breaker is open
+        self.rejected = 0
+        # amount of extra requests sent because the original ones took too long
+        self.hedged = 0
+        self.total_time = 0
+
+    def dump(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "throttled": self.throttled,
+            "coalesced": self.coalesced,
+            "shed": self.shed,
+            "rejected": self.rejected,
+            "hedged": self.hedged,
+            "avg_time": (self.total_time / self.requests) if self.requests else 0
+        }
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of the requests to a service over the last `window` seconds, and once too many of them
+    have failed (or have been too slow), opens: the requests are failed right away, without waiting for
+    the service, for `cooldown` seconds. After that, a few requests are let through to probe the service
+    (half-open state): the breaker is closed back if they succeed, or opened again if they don't.
+
+    A request is admitted with a ticket (see admit), and only the outcomes of the requests admitted
+    in the current state count: a request that has been sent before the breaker has opened cannot
+    close it back, or take a place of a probe.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, service, window=30, min_requests=20, error_rate=0.5, slow_call_time=4,
+                 cooldown=10, max_probes=1):
+        self.service = service
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_call_time = slow_call_time
+        self.cooldown = cooldown
+        self.max_probes = max_probes
+
+        self.state = CircuitBreaker.CLOSED
+        # changes along with the state, see admit
+        self.epoch = 0
+        self.opened_at = 0
+        self.probes = 0
+        # (time, failed) of the recent requests
+        self.outcomes = deque()
+        self.failures = 0
+        self.trips = 0
+
+    def __prune__(self, now):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            _, failed = self.outcomes.popleft()
+            if failed:
+                self.failures -= 1
+
+    def __set_state__(self, state):
+        if self.state == state:
+            return
+
+        logging.warning("Circuit breaker for '{0}' is {1} now".format(self.service, state))
+        self.state = state
+        self.epoch += 1
+
+        if state == CircuitBreaker.OPEN:
+            self.opened_at = time.time()
+            self.trips += 1
+        elif state == CircuitBreaker.CLOSED:
+            self.outcomes.clear()
+            self.failures = 0
+
+        application = Server.instance()
+        if application:
+            application.monitor_action("circuit_breaker", {
+                "open": 1 if state == CircuitBreaker.OPEN else 0,
+                "half_open": 1 if state == CircuitBreaker.HALF_OPEN else 0
+            }, service=self.service)
+
+    def admit(self):
+        """
+        Checks if a request can be made: returns None if it cannot, or a ticket otherwise.
+        The ticket should be passed to either record or abandon once the request is complete.
+        """
+        if self.state == CircuitBreaker.CLOSED:
+            return self.epoch
+
+        if self.state == CircuitBreaker.OPEN:
+            if time.time() - self.opened_at < self.cooldown:
+                return None
+            self.probes = 0
+            self.__set_state__(CircuitBreaker.HALF_OPEN)
+
+        if self.probes >= self.max_probes:
+            return None
+
+        self.probes += 1
+        return self.epoch
+
+    def record(self, ticket, failed, duration):
+        if ticket != self.epoch:
+            # admitted in another state, tells nothing about this one
+            return
+
+        failed = failed or duration >= self.slow_call_time
+
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.probes -= 1
+            self.__set_state__(CircuitBreaker.OPEN if failed else CircuitBreaker.CLOSED)
+            return
+
+        now = time.time()
+        self.outcomes.append((now, failed))
+        if failed:
+            self.failures += 1
+        self.__prune__(now)
+
+        if len(self.outcomes) >= self.min_requests and self.failures >= self.error_rate * len(self.outcomes):
+            self.__set_state__(CircuitBreaker.OPEN)
+
+    def abandon(self, ticket):
+        """
+        The request has been given up on by the caller, so it tells nothing about the service
+        """
+        if ticket == self.epoch and self.state == CircuitBreaker.HALF_OPEN:
+            self.probes -= 1
+
+    def dump(self):
+        return {
+            "state": self.state,
+            "requests": len(self.outcomes),
+            "failures": self.failures,
+            "trips": self.trips
+        }
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the last `size` requests, to tell a percentile of them
+    """
+
+    def __init__(self, size=256, min_samples=50):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.added = 0
+        self.cached = {}
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.added += 1
+
+        # do not sort the samples on every request
+        if self.added % 16 == 0:
+            self.cached = {}
+
+    def percentile(self, percent):
+        """
+        Returns the latency `percent` percent of the requests are faster than, or None if not sure yet
+        """
+        if len(self.samples) < self.min_samples:
+            return None
+
+        value = self.cached.get(percent)
+        if value is None:
+            ordered = sorted(self.samples)
+            value = ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+            self.cached[percent] = value
+
+        return value
+
+
+class HedgeBudget(object):
+    """
+    Limits the hedged requests to `ratio` of all of the requests: each request earns a fraction of a token,
+    and a hedged request spends a whole one.
+    """
+
+    def __init__(self, ratio=0.05, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = 0
+
+    def earn(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def spend(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class APIClient(object, metaclass=singleton.Singleton):
+    """
+    A shared client for the requests the javascript APIs make to other services.
+
+    The requests go through a single Internal instance, that keeps its RabbitMQ connections open and pooled,
+    so no connection is ever set up on a call. On top of that, the client limits amount of concurrent
+    requests to each service, and collects per-service statistics.
+
+    Unlike Internal, raises APIError, so the API methods can let it through to the javascript side as is.
+
+    A request can be given the deadline of the call it's made for, then it's never waited for longer than
+    the call has left, and not sent at all if the call has run out of time already.
+
+    Latency-critical idempotent reads can be requested with hedge=True: if such a request is not complete
+    within the usual time (a percentile of the latencies of the same requests), an identical request is sent
+    (that most likely lands on another instance of the service), and whichever completes first wins.
+    Amount of such extra requests is limited with a budget.
+
+    Idempotent reads can be requested with coalesce=True: identical requests (same service, method and arguments)
+    issued while one is already in progress do not go to the service, but share the result of that one.
+    """
+
+    def __init__(self):
+        self.internal = Internal()
+        self.max_requests_per_service = options.js_api_max_requests_per_service
+        self.limits = {}
+        self.services = {}
+        self.breakers = {}
+        self.flights = SingleFlight()
+        self.latencies = {}
+        self.hedge_budget = HedgeBudget(ratio=options.js_api_hedge_budget / 100.0)
+        self.hedge_percentile = options.js_api_hedge_percentile
+
+    def __service__(self, service):
+        stats = self.services.get(service)
+        if stats is None:
+            stats = ServiceStats()
+            self.services[service] = stats
+            self.limits[service] = Semaphore(self.max_requests_per_service)
+            self.breakers[service] = CircuitBreaker(
+                service,
+                window=options.js_api_breaker_window,
+                min_requests=options.js_api_breaker_min_requests,
+                error_rate=options.js_api_breaker_error_rate / 100.0,
+                slow_call_time=options.js_api_breaker_slow_call_time,
+                cooldown=options.js_api_breaker_cooldown)
+        return stats
+
+    @staticmethod
+    def __is_failure__(error):
+        # client errors (like 404 for no such profile) are fine as far as the service health is concerned
+        return error.code >= 500 or error.code == 408
+
+    @staticmethod
+    def __is_timeout__(error):
+        return error.code in (408, 599)
+
+    @staticmethod
+    def __monitor__(name_property, service):
+        application = Server.instance()
+        if application:
+            application.monitor_rate("api", name_property, service=service)
+
+    def stats(self):
+        return {
+            "connections": sum(len(pool) for pool in self.internal.pools.values()),
+            "services": {
+                service: dict(stats.dump(), breaker=self.breakers[service].dump())
+                for service, stats in self.services.items()
+            }
+        }
+
+    @staticmethod
+    def __coalesce_key__(service, method, kwargs):
+        return service + ":" + method + ":" + ujson.dumps(kwargs, sort_keys=True)
+
+    async def request(self, service, method, timeout=JSONRPC_TIMEOUT, coalesce=False, deadline=None,
+                      hedge=False, **kwargs):
+        remaining = None
+
+        if deadline is not None:
+            # there is no point to wait for longer than the caller would
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                self.__service__(service).shed += 1
+                APIClient.__monitor__("shed", service)
+                raise APIError(408, "Call deadline exceeded")
+
+            if remaining >= timeout:
+                remaining = None
+
+        run = self.__hedged_request__ if hedge else self.__request__
+
+        if not coalesce:
+            if remaining is not None:
+                # the request could time out because of the caller, not the service
+                return await run(service, method, remaining, True, kwargs)
+            return await run(service, method, timeout, False, kwargs)
+
+        key = APIClient.__coalesce_key__(service, method, kwargs)
+
+        if key in self.flights:
+            self.__service__(service).coalesced += 1
+            APIClient.__monitor__("coalesced", service)
+
+        # a shared request is not limited by the deadline of the caller that happened to start it,
+        # instead, each caller waits for it no longer than it has
+        flight = self.flights.start(key, run, service, method, timeout, False, kwargs)
+
+        if remaining is None:
+            return await asyncio.shield(flight)
+
+        try:
+            return await with_timeout(datetime.timedelta(seconds=remaining), flight, quiet_exceptions=(APIError,))
+        except TimeoutError:
+            raise APIError(408, "Call deadline exceeded")
+
+    async def __hedged_request__(self, service, method, timeout, cut_short, kwargs):
+        key = service + ":" + method
+
+        latencies = self.latencies.get(key)
+        if latencies is None:
+            latencies = LatencyTracker()
+            self.latencies[key] = latencies
+
+        self.hedge_budget.earn()
+        delay = latencies.percentile(self.hedge_percentile)
+        started_at = time.time()
+
+        requests = [asyncio.ensure_future(self.__request__(service, method, timeout, cut_short, kwargs))]
+
+        try:
+            if delay is not None and delay < timeout:
+                done, pending = await asyncio.wait(requests, timeout=delay)
+
+                if not done and self.hedge_budget.spend():
+                    self.__service__(service).hedged += 1
+                    APIClient.__monitor__("hedged", service)
+                    requests.append(asyncio.ensure_future(
+                        self.__request__(service, method, timeout, cut_short, kwargs)))
+
+            pending = requests
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for request in done:
+                    if request.exception() is None:
+                        latencies.add(time.time() - started_at)
+                        return request.result()
+
+                # a failed request still has a chance to be saved by the other one
+                if not pending:
+                    return done.pop().result()
+        finally:
+            # the loser is not needed anymore
+            for request in requests:
+                if not request.done():
+                    request.cancel()
+
+    async def __request__(self, service, method, timeout, cut_short, kwargs):
+        """
+        If the timeout has been cut short (to the caller's deadline), a timeout tells nothing about
+        the service, and is not recorded by the circuit breaker.
+        """
+        stats = self.__service__(service)
+        limit = self.limits[service]
+        breaker = self.breakers[service]
+
+        ticket = breaker.admit()
+        if ticket is None:
+            stats.rejected += 1
+            APIClient.__monitor__("rejected", service)
+            raise APIError(503, "Service '{0}' is unavailable".format(service))
+
+        if stats.in_flight >= self.max_requests_per_service:
+            stats.throttled += 1
+
+        try:
+            async with limit:
+                stats.requests += 1
+                stats.in_flight += 1
+                stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+                # the time spent waiting for the limit is not the service's fault
+                requested_at = time.time()
+
+                try:
+                    result = await self.internal.request(service, method, timeout=timeout, **kwargs)
+                except InternalError as e:
+                    stats.errors += 1
+                    APIClient.__monitor__("error", service)
+                    raise APIError(e.code, e.body)
+                finally:
+                    stats.in_flight -= 1
+                    stats.total_time += time.time() - requested_at
+        except APIError as e:
+            if cut_short and APIClient.__is_timeout__(e):
+                breaker.abandon(ticket)
+            else:
+                breaker.record(ticket, APIClient.__is_failure__(e), time.time() - requested_at)
+            raise
+        except BaseException:
+            breaker.abandon(ticket)
+            raise
+
+        breaker.record(ticket, False, time.time() - requested_at)
+
+        APIClient.__monitor__("request", service)
+        return result
+
+
+class RequestBatch(object):
+    def __init__(self, key):
+        self.key = key
+        self.items = []
+        self.futures = []
+
+
+class RequestBatcher(object):
+    """
+    Collects requests issued within the same loop tick (or within `window` seconds after the first one),
+    so they could be sent to the service with a single bulk request.
+
+    Requests are grouped by a key (for example, a gamespace), every group is flushed separately with
+    the `flush(key, items)` coroutine, that should return a list of results, one for every item. An item
+    that has failed on its own can have an exception instance as a result, so only the request behind it
+    is rejected, while the rest are resolved as usual.
+
+    batcher = RequestBatcher(send_messages)
+    result = await batcher.add(gamespace, message)
+
+    """
+
+    def __init__(self, flush, window=0, max_size=100):
+        self.flush = flush
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.pending = {}
+
+        self.batches = 0
+        self.items = 0
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_size": (self.items / self.batches) if self.batches else 0
+        }
+
+    async def add(self, key, item):
+        batch = self.pending.get(key)
+
+        if batch is None:
+            batch = RequestBatch(key)
+            self.pending[key] = batch
+
+            if self.window > 0:
+                IOLoop.current().call_later(self.window, self.__flush__, batch)
+            else:
+                IOLoop.current().add_callback(self.__flush__, batch)
+
+        future = Future()
+        batch.items.append(item)
+        batch.futures.append(future)
+
+        if len(batch.items) >= self.max_size:
+            self.__flush__(batch)
+
+        return await future
+
+    def __flush__(self, batch):
+        # the batch could have been flushed already because it's got full
+        if self.pending.get(batch.key) is not batch:
+            return
+
+        del self.pending[batch.key]
+        IOLoop.current().spawn_callback(self.__process__, batch)
+
+    async def __process__(self, batch):
+        self.batches += 1
+        self.items += len(batch.items)
+
+        try:
+            results = await self.flush(batch.key, batch.items)
+        except Exception as e:
+            results = [e] * len(batch.futures)
+        else:
+            if len(results) != len(batch.futures):
+                logging.error("Batch of {0} items has got {1} results".format(len(batch.futures), len(results)))
+                results = [APIError(500, "Bad batch response")] * len(batch.futures)
+
+        for future, result in zip(batch.futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
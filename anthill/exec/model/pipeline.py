@@ -0,0 +1,191 @@
+
+from tornado.gen import with_timeout, TimeoutError
+
+from anthill.common import singleton
+
+from . util import APIError, PromiseContext, JSFuture, process_error
+
+import asyncio
+import datetime
+import time
+
+
+class JavascriptCall(object):
+    """
+    A single call of a javascript function, as it goes through the stages of the CallPipeline
+    """
+
+    # a plain function of a build, see JavascriptBuild.call
+    FUNCTION = "function"
+    # a method of a session, see JavascriptSession.call
+    SESSION = "session"
+    # a method of a session the service calls itself (like 'released')
+    INTERNAL = "internal"
+
+    __slots__ = ("kind", "name", "args", "handler", "started_at", "completed", "result", "error")
+
+    def __init__(self, kind, name, args, handler):
+        self.kind = kind
+        self.name = name
+        self.args = args
+        self.handler = handler
+        self.started_at = time.time()
+        self.completed = False
+        self.result = None
+        self.error = None
+
+    def complete(self, result):
+        """
+        Completes the call with a result without running the function at all, see CallStage.before
+        """
+        self.completed = True
+        self.result = result
+
+
+class CallStage(object):
+    """
+    A stage of the CallPipeline: metrics, caching, admission control, tracing and such.
+
+    The hooks are plain (not async) methods, a stage only needs to override the ones it cares about.
+    """
+
+    def before(self, call):
+        """
+        Called before the function is called. Could reject the call by raising
+        JavascriptExecutionError, or complete it by calling call.complete(result),
+        in which case the function is not called, and the rest of the 'before' hooks are skipped.
+        """
+        pass
+
+    def after(self, call):
+        """
+        Called once the call is complete, successfully (call.result) or not (call.error), for the stages
+        that have been passed by the call only, in reverse order. A stage that has rejected the call
+        is not called.
+        """
+        pass
+
+
+class CallStats(CallStage):
+    """
+    Counts calls, errors and time spent, per kind of call
+    """
+
+    def __init__(self):
+        self.kinds = {}
+
+    def __kind__(self, kind):
+        stats = self.kinds.get(kind)
+        if stats is None:
+            stats = {
+                "calls": 0,
+                "errors": 0,
+                "in_flight": 0,
+                "total_time": 0
+            }
+            self.kinds[kind] = stats
+        return stats
+
+    def before(self, call):
+        stats = self.__kind__(call.kind)
+        stats["calls"] += 1
+        stats["in_flight"] += 1
+
+    def after(self, call):
+        stats = self.__kind__(call.kind)
+        stats["in_flight"] -= 1
+        stats["total_time"] += time.time() - call.started_at
+        if call.error is not None:
+            stats["errors"] += 1
+
+    def dump(self):
+        return {
+            kind: {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "in_flight": stats["in_flight"],
+                "avg_time": (stats["total_time"] / stats["calls"]) if stats["calls"] else 0
+            }
+            for kind, stats in self.kinds.items()
+        }
+
+
+class CallPipeline(object, metaclass=singleton.Singleton):
+    """
+    The way every javascript function is called (both the plain functions of the builds and the methods
+    of the sessions): sets up the call context, calls the function, translates the errors into
+    JavascriptExecutionError, waits for the result and completes whatever the call has deferred
+    (both together no longer than call_timeout).
+
+    The stages are called around each call in the order they've been added, see CallStage.
+    Calls are counted by default (see CallStats).
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.stats = CallStats()
+        self.add_stage(self.stats)
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+
+    def remove_stage(self, stage):
+        self.stages.remove(stage)
+
+    async def invoke(self, kind, context, method, name, args, handler, call_timeout=10):
+        call = JavascriptCall(kind, name, args, handler)
+        entered = []
+
+        try:
+            for stage in self.stages:
+                stage.before(call)
+                entered.append(stage)
+                if call.completed:
+                    break
+            else:
+                call.result = await self.__execute__(context, method, call, call_timeout)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            for stage in reversed(entered):
+                stage.after(call)
+
+        return call.result
+
+    @staticmethod
+    async def __execute__(context, method, call, call_timeout):
+        handler = call.handler
+        token = PromiseContext.current.set(handler)
+
+        try:
+            future = context.async_call(method, (call.args,), JSFuture)
+        except Exception as e:
+            raise process_error(e)
+        finally:
+            # whatever runs later on behalf of the call, runs in a context of its own
+            PromiseContext.current.reset(token)
+
+        try:
+            if future.done() and not handler.deferred:
+                return future.result()
+
+            completion = asyncio.ensure_future(CallPipeline.__complete__(future, handler))
+
+            try:
+                return await with_timeout(datetime.timedelta(seconds=call_timeout), completion)
+            except TimeoutError:
+                completion.cancel()
+                raise APIError(408, "Total function '{0}' call timeout ({1})".format(
+                    call.name, call_timeout))
+        except BaseException:
+            # nobody is going to wait for what the call has started
+            handler.cancel()
+            raise
+
+    @staticmethod
+    async def __complete__(future, handler):
+        result = await future
+        # the call is not complete until everything it has deferred is
+        await handler.flush()
+        return result
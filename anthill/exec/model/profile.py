@@ -0,0 +1,269 @@
+
+from tornado.gen import Future
+from tornado.ioloop import IOLoop
+
+from anthill.common.options import options
+from anthill.common import singleton
+
+from . client import APIClient
+from .. import options as _opts
+
+import asyncio
+import logging
+import time
+
+PROFILE_TIMEOUT = 5
+
+
+def has_functions(fields):
+    """
+    Checks if the fields have profile functions ({"@func": "++", "@value": 1} and such) in them
+    """
+    if not isinstance(fields, dict):
+        return False
+
+    if "@func" in fields:
+        return True
+
+    for value in fields.values():
+        if has_functions(value):
+            return True
+
+    return False
+
+
+def can_merge_fields(old, new):
+    for key, value in new.items():
+        if key not in old or not isinstance(value, dict):
+            continue
+
+        old_value = old[key]
+
+        # the field is deleted first, and then replaced with an object, that cannot be described by a single merge
+        if old_value is None:
+            return False
+
+        if isinstance(old_value, dict) and not can_merge_fields(old_value, value):
+            return False
+
+    return True
+
+
+def merge_fields(old, new):
+    """
+    Applies an update (with merge=True) on top of another one, the same way the profile service would:
+    objects are merged together, None deletes a field, anything else is replaced.
+    """
+    for key, value in new.items():
+        old_value = old.get(key)
+
+        if isinstance(value, dict):
+            if key not in old:
+                old[key] = value
+            elif isinstance(old_value, dict):
+                merge_fields(old_value, value)
+            # the service ignores an object being merged into a plain value
+            continue
+
+        old[key] = value
+
+
+def split_path(path):
+    return [key for key in path.split("/") if key]
+
+
+def paths_overlap(a, b):
+    a = split_path(a)
+    b = split_path(b)
+    length = min(len(a), len(b))
+    return a[:length] == b[:length]
+
+
+class ProfileCache(object):
+    """
+    A cache of the profile of a single account, kept by a session, so the session does not have to
+    request the profile each time the script reads it.
+
+    Profiles are cached by path. A lookup of a path is served by a cached parent path as well,
+    and an update of a path invalidates everything cached either above or below it.
+    The script APIs that change the profile invalidate it (see JavascriptCallHandler.profile_changed),
+    but there are no notifications about changes made elsewhere, so entries expire in `ttl` seconds.
+    """
+
+    def __init__(self, ttl=30, max_len=64):
+        self.ttl = ttl
+        self.max_len = max_len
+        self.entries = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """
+        Returns a tuple (found, profile)
+        """
+        keys = split_path(path)
+        now = time.time()
+
+        for length in range(0, len(keys) + 1):
+            entry = self.entries.get(tuple(keys[:length]))
+            if entry is None:
+                continue
+
+            value, cached_at = entry
+            if now - cached_at >= self.ttl:
+                continue
+
+            for key in keys[length:]:
+                if not isinstance(value, dict):
+                    value = None
+                    break
+                value = value.get(key)
+
+            self.hits += 1
+            return True, value
+
+        self.misses += 1
+        return False, None
+
+    def set(self, path, value):
+        self.invalidate(path)
+
+        if len(self.entries) >= self.max_len:
+            # the oldest one goes away
+            self.entries.pop(next(iter(self.entries)))
+
+        self.entries[tuple(split_path(path))] = (value, time.time())
+
+    def invalidate(self, path=""):
+        keys = split_path(path)
+
+        for cached in list(self.entries.keys()):
+            length = min(len(cached), len(keys))
+            if list(cached[:length]) == keys[:length]:
+                del self.entries[cached]
+
+
+class PendingProfileUpdate(object):
+    def __init__(self, path, fields, merge):
+        self.path = path
+        self.fields = fields
+        self.merge = merge
+        # updates with functions depend on the actual profile state, so nothing is merged into them
+        self.mergeable = merge and not has_functions(fields)
+        self.future = Future()
+
+
+class ProfileWriter(object, metaclass=singleton.Singleton):
+    """
+    Write-behind for the profile updates: instead of sending an update right away, it's kept pending
+    for `window` seconds, and other updates of the same account and path are merged into it,
+    so several updates in a row end up as a single request to the profile service.
+
+    Pending updates are sent earlier if someone needs them to be complete (see flush), for example,
+    when the call that made them is about to return, or the profile is about to be read.
+
+    Updates are always sent in the order they've been made. Updates with profile functions, and
+    updates with merge=False are never merged (but are deferred still).
+    """
+
+    def __init__(self):
+        self.window = options.js_profile_update_window / 1000.0
+        self.pending = {}
+        self.flushing = {}
+
+        self.updates = 0
+        self.requests = 0
+
+    def stats(self):
+        return {
+            "pending": sum(len(pending) for pending in self.pending.values()),
+            "updates": self.updates,
+            "requests": self.requests
+        }
+
+    def update(self, gamespace, account, path, fields, merge=True):
+        """
+        Schedules an update, returns a Future that is resolved with the updated profile
+        once the update is actually complete
+        """
+        key = (gamespace, account)
+
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = []
+            self.pending[key] = pending
+            IOLoop.current().call_later(self.window, self.__flush_pending__, key, pending)
+
+        self.updates += 1
+
+        update = PendingProfileUpdate(path, fields, merge)
+
+        if update.mergeable:
+            for existing in reversed(pending):
+                if existing.path == path:
+                    if existing.mergeable and can_merge_fields(existing.fields, fields):
+                        merge_fields(existing.fields, fields)
+                        return existing.future
+                    break
+
+                # merging into an older update would change the order they are applied in
+                if paths_overlap(existing.path, path):
+                    break
+
+        pending.append(update)
+        return update.future
+
+    def __flush_pending__(self, key, pending):
+        # the updates have been flushed already
+        if self.pending.get(key) is not pending:
+            return
+
+        IOLoop.current().spawn_callback(self.flush, *key)
+
+    async def flush(self, gamespace, account):
+        """
+        Sends the pending updates of the account, if any
+        """
+        key = (gamespace, account)
+
+        # wait for the updates being sent already, so everything is applied in order
+        while key in self.flushing:
+            await asyncio.shield(self.flushing[key])
+
+        pending = self.pending.pop(key, None)
+        if not pending:
+            return
+
+        # the updates are sent on their own, even if the one who's asked for it is cancelled
+        flushing = asyncio.ensure_future(self.__send__(key, pending))
+        self.flushing[key] = flushing
+        await asyncio.shield(flushing)
+
+    async def __send__(self, key, pending):
+        gamespace, account = key
+
+        try:
+            for update in pending:
+                self.requests += 1
+
+                try:
+                    result = await self.__request__(gamespace, account, update)
+                except Exception as e:
+                    logging.warning("Failed to update profile {0}/{1}: {2}".format(gamespace, account, str(e)))
+                    update.future.set_exception(e)
+                else:
+                    update.future.set_result(result)
+        finally:
+            del self.flushing[key]
+
+    # noinspection PyMethodMayBeStatic
+    async def __request__(self, gamespace, account, update):
+        return await APIClient().request(
+            "profile", "update_profile",
+            timeout=PROFILE_TIMEOUT,
+            gamespace_id=gamespace,
+            account_id=account,
+            fields=update.fields,
+            path=update.path,
+            merge=update.merge)
@@ -0,0 +1,231 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.source import SourceCodeRoot, Project, ProjectBuild
+from anthill.common.server import Server
+
+from shutil import rmtree
+
+import hashlib
+import logging
+import time
+import os
+
+
+class GitOperation(object):
+    def __init__(self, name, method):
+        self.name = name
+        self.method = method
+        self.scheduled_at = time.time()
+
+        # amount of requests currently awaiting this operation to complete
+        self.waiters = 0
+
+    async def wait(self, future):
+        self.waiters += 1
+        try:
+            result = await future
+        finally:
+            self.waiters -= 1
+        return result
+
+
+class GitOperationScheduler(object):
+    """
+    Runs git operations (clones and checkouts) with limited parallelism, so a cold start of a node with many
+    tenants does not spawn dozens of git processes at once, all of them timing out together.
+
+    Operations that have requests waiting for them are started first, the rest are started in order.
+    """
+
+    def __init__(self, max_parallel=4):
+        self.max_parallel = max(1, max_parallel)
+        self.queue = []
+        self.running = 0
+
+        self.completed = 0
+        self.total_wait_time = 0
+        self.total_duration = 0
+
+    def schedule(self, name, method):
+        operation = GitOperation(name, method)
+        self.queue.append(operation)
+
+        # the requests that have caused the operation get a chance to declare themselves as waiters
+        IOLoop.current().add_callback(self.__process__)
+        return operation
+
+    def stats(self):
+        return {
+            "queue": len(self.queue),
+            "running": self.running,
+            "completed": self.completed,
+            "avg_wait_time": (self.total_wait_time / self.completed) if self.completed else 0,
+            "avg_duration": (self.total_duration / self.completed) if self.completed else 0
+        }
+
+    def __process__(self):
+        while self.queue and self.running < self.max_parallel:
+            # max picks the first one out of equals, so the order is preserved
+            operation = max(self.queue, key=lambda o: o.waiters)
+            self.queue.remove(operation)
+            self.running += 1
+            IOLoop.current().spawn_callback(self.__run__, operation)
+
+    async def __run__(self, operation):
+        started_at = time.time()
+        wait_time = started_at - operation.scheduled_at
+
+        try:
+            await operation.method()
+        except Exception:
+            logging.exception("Git operation {0} failed".format(operation.name))
+        finally:
+            duration = time.time() - started_at
+
+            self.running -= 1
+            self.completed += 1
+            self.total_wait_time += wait_time
+            self.total_duration += duration
+
+            application = Server.instance()
+            if application:
+                application.monitor_action("git_operation", {
+                    "wait_time": wait_time,
+                    "duration": duration,
+                    "queue": len(self.queue),
+                    "waiters": operation.waiters
+                })
+
+            self.__process__()
+
+
+class SharedProjectBuild(ProjectBuild):
+    """
+    A checkout of a single commit. Since a commit is content-addressed, the checkout is shared by every
+    gamespace that points at the same repository.
+
+    The commit is checked out into a temporary directory first, and then renamed, so an existing build
+    directory is always a complete one and can be safely reused after a restart.
+    """
+
+    PARTIAL_SUFFIX = ".partial"
+
+    def __init__(self, commit, build_dir, project):
+        super(SharedProjectBuild, self).__init__(commit, build_dir, project)
+        self.operation = None
+
+    async def init(self):
+        return await self.operation.wait(super(SharedProjectBuild, self).init())
+
+    async def __setup__(self):
+        if os.path.isdir(self.build_dir):
+            return
+
+        build_dir = self.build_dir
+        partial_dir = build_dir + SharedProjectBuild.PARTIAL_SUFFIX
+
+        # a leftover of a checkout that has been interrupted
+        rmtree(partial_dir, ignore_errors=True)
+
+        self.build_dir = partial_dir
+
+        try:
+            await self.__checkout__()
+        except BaseException:
+            # let the next request to try again
+            self.project.builds.pop(self.commit, None)
+            raise
+        finally:
+            self.build_dir = build_dir
+
+        os.rename(partial_dir, build_dir)
+
+
+class SharedProject(Project):
+    """
+    A bare repository shared across gamespaces: every project pointing at the same repository url (branch and key)
+    fetches into the same object store, and checks out commits into the same builds directory.
+    """
+
+    def __init__(self, root, project_key, project_dir, remote_url,
+                 branch_name=SourceCodeRoot.DEFAULT_BRANCH, ssh_private_key=None):
+        super(SharedProject, self).__init__(project_dir, remote_url, branch_name=branch_name,
+                                            ssh_private_key=ssh_private_key)
+        self.root = root
+        self.project_key = project_key
+        self.operation = None
+
+    async def init(self):
+        return await self.operation.wait(super(SharedProject, self).init())
+
+    def build(self, commit):
+        build = self.builds.get(commit)
+        if build:
+            return build
+
+        build_dir = os.path.join(self.builds_dir, commit)
+        build = SharedProjectBuild(commit, build_dir, self)
+        self.builds[commit] = build
+
+        build.operation = self.root.scheduler.schedule("checkout " + commit, build.__do_setup__)
+        return build
+
+    async def __setup__(self):
+        try:
+            result = await super(SharedProject, self).__setup__()
+        except BaseException:
+            # let the next request to try again
+            self.root.projects.pop(self.project_key, None)
+            raise
+        return result
+
+
+class SharedSourceCodeRoot(SourceCodeRoot):
+    """
+    Unlike SourceCodeRoot, that clones a repository for each gamespace/project separately,
+    keeps a single repository per repository url, branch and ssh key:
+
+    <root_dir>/repositories/<sha1 of url, branch and key>/repo.git
+    <root_dir>/repositories/<sha1 of url, branch and key>/builds/<commit>
+
+    The key is a part of the repository key, so a gamespace is never fetching with a key of some other
+    gamespace: once a key is rotated or revoked, only the gamespaces using it are affected.
+
+    Access to the repository is still validated for each gamespace separately, once the project settings
+    are updated (see validate_repository_url).
+    """
+
+    REPOSITORIES_DIR = "repositories"
+
+    def __init__(self, root_dir, scheduler=None):
+        super(SharedSourceCodeRoot, self).__init__(root_dir)
+        self.scheduler = scheduler or GitOperationScheduler()
+
+    @staticmethod
+    def __get_repository_key__(remote_url, branch_name, ssh_private_key=None):
+        key = str(remote_url) + "\n" + str(branch_name)
+        if ssh_private_key:
+            key += "\n" + hashlib.sha1(str(ssh_private_key).encode("utf-8")).hexdigest()
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def project(self, gamespace_id, project_name, remote_url, branch_name=SourceCodeRoot.DEFAULT_BRANCH,
+                ssh_private_key=""):
+
+        project_key = SharedSourceCodeRoot.__get_repository_key__(remote_url, branch_name, ssh_private_key)
+
+        project = self.projects.get(project_key)
+        if project:
+            return project
+
+        project_dir = os.path.join(self.root_dir, SharedSourceCodeRoot.REPOSITORIES_DIR, project_key)
+
+        logging.info("Using shared repository {0} ({1}) for {2}/{3}".format(
+            remote_url, branch_name, gamespace_id, project_name))
+
+        project = SharedProject(self, project_key, project_dir, remote_url,
+                                branch_name=branch_name, ssh_private_key=ssh_private_key)
+        self.projects[project_key] = project
+
+        project.operation = self.scheduler.schedule("clone " + str(remote_url), project.__do_setup__)
+        return project
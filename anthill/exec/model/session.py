@@ -1,12 +1,16 @@
-from tornado.gen import with_timeout, TimeoutError
 # noinspection PyUnresolvedReferences
 from v8py import JSException, JSPromise, Context, new, JavaScriptTerminated
 
 from anthill.common.access import InternalError
 from anthill.common.validate import validate
-from . util import APIError, PromiseContext, JavascriptCallHandler, JavascriptExecutionError, JSFuture
-
-import datetime
+from anthill.common.options import options
+from . util import APIError, PromiseContext, JavascriptCallHandler
+from . util import cancel_tasks
+from . pipeline import CallPipeline, JavascriptCall
+from . profile import ProfileCache
+from .. import options as _opts
+
+import time
 import sys
 import logging
 
@@ -33,6 +37,10 @@ class JavascriptSession(object):
         self.log = log
         self.debug = debug
         self.promise_type = promise_type
+        self.profile_cache = ProfileCache(ttl=options.js_session_profile_cache_ttl) \
+            if options.js_session_profile_cache_ttl > 0 else None
+        # tasks started by the calls of the session, that are still running
+        self.tasks = set()
 
     async def call_internal_method(self, method_name, args, call_timeout=10):
 
@@ -43,45 +51,14 @@ class JavascriptSession(object):
 
         context = self.build.context
         handler = JavascriptCallHandler(self.cache, self.env, context,
-                                        debug=self.debug, promise_type=self.promise_type)
+                                        debug=self.debug, promise_type=self.promise_type,
+                                        profile_cache=self.profile_cache, session_tasks=self.tasks,
+                                        deadline=time.time() + call_timeout)
         if self.log:
             handler.log = self.log
-        PromiseContext.current = handler
-
-        try:
-            future = context.async_call(method, (args,), JSFuture)
-        except JSException as e:
-            value = e.value
-            if hasattr(value, "code"):
-                if hasattr(value, "stack"):
-                    raise JavascriptExecutionError(value.code, value.message, stack=str(value.stack))
-                else:
-                    raise JavascriptExecutionError(value.code, value.message)
-            if hasattr(e, "stack"):
-                raise JavascriptExecutionError(500, str(e), stack=str(e.stack))
-            raise JavascriptExecutionError(500, str(e))
-        except APIError as e:
-            raise JavascriptExecutionError(e.code, e.message)
-        except InternalError as e:
-            raise JavascriptExecutionError(
-                e.code, "Internal error: " + e.body)
-        except JavaScriptTerminated:
-            raise JavascriptExecutionError(
-                408, "Evaluation process timeout: function shouldn't be "
-                     "blocking and should rely on async methods instead.")
-        except Exception as e:
-            raise JavascriptExecutionError(500, str(e))
 
-        if future.done():
-            return future.result()
-
-        try:
-            result = await with_timeout(datetime.timedelta(seconds=call_timeout), future)
-        except TimeoutError:
-            raise APIError(408, "Total function '{0}' call timeout ({1})".format(
-                method_name, call_timeout))
-        else:
-            return result
+        return await CallPipeline().invoke(
+            JavascriptCall.INTERNAL, context, method, method_name, args, handler, call_timeout)
 
     @validate(method_name="str_name", args="json_dict")
     async def call(self, method_name, args, call_timeout=10):
@@ -98,52 +75,21 @@ class JavascriptSession(object):
 
         context = self.build.context
         handler = JavascriptCallHandler(self.cache, self.env, context,
-                                        debug=self.debug, promise_type=self.promise_type)
+                                        debug=self.debug, promise_type=self.promise_type,
+                                        profile_cache=self.profile_cache, session_tasks=self.tasks,
+                                        deadline=time.time() + call_timeout)
         if self.log:
             handler.log = self.log
 
-        PromiseContext.current = handler
-
-        try:
-            future = context.async_call(method, (args,), JSFuture)
-        except JSException as e:
-            value = e.value
-            if hasattr(value, "code"):
-                if hasattr(value, "stack"):
-                    raise JavascriptExecutionError(value.code, value.message, stack=str(value.stack))
-                else:
-                    raise JavascriptExecutionError(value.code, value.message)
-            if hasattr(e, "stack"):
-                raise JavascriptExecutionError(500, str(e), stack=str(e.stack))
-            raise JavascriptExecutionError(500, str(e))
-        except APIError as e:
-            raise JavascriptExecutionError(e.code, e.message)
-        except InternalError as e:
-            raise JavascriptExecutionError(
-                e.code, "Internal error: " + e.body)
-        except JavaScriptTerminated:
-            raise JavascriptExecutionError(
-                408, "Evaluation process timeout: function shouldn't be "
-                     "blocking and should rely on async methods instead.")
-        except Exception as e:
-            raise JavascriptExecutionError(500, str(e))
-
-        if future.done():
-            return future.result()
-
-        try:
-            result = await with_timeout(datetime.timedelta(seconds=call_timeout), future)
-        except TimeoutError:
-            raise APIError(408, "Total function '{0}' call timeout ({1})".format(
-                method_name, call_timeout))
-        else:
-            return result
+        return await CallPipeline().invoke(
+            JavascriptCall.SESSION, context, method, method_name, args, handler, call_timeout)
 
     @validate(value="str")
     async def eval(self, value):
 
-        handler = JavascriptCallHandler(self.cache, self.env, self.build.context)
-        PromiseContext.current = handler
+        handler = JavascriptCallHandler(self.cache, self.env, self.build.context,
+                                        profile_cache=self.profile_cache, session_tasks=self.tasks)
+        token = PromiseContext.current.set(handler)
 
         try:
             result = self.build.context.eval(str(value))
@@ -158,14 +104,22 @@ class JavascriptSession(object):
             raise
         except Exception as e:
             raise APIError(500, e)
+        finally:
+            # whatever runs later on behalf of the call, runs in a context of its own
+            PromiseContext.current.reset(token)
 
         return result
 
     async def release(self, code=1006, reason="Closed normally"):
-        await self.call_internal_method("released", {
-            "code": code,
-            "reason": reason
-        })
+        try:
+            await self.call_internal_method("released", {
+                "code": code,
+                "reason": reason
+            })
+        finally:
+            # whatever the session has started is of no use anymore
+            cancel_tasks(self.tasks)
+
         if self.build:
             await self.build.session_released(self)
             self.debug = None
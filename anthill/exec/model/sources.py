@@ -2,6 +2,10 @@
 from anthill.common.validate import validate
 from anthill.common.model import Model
 from anthill.common.source import DatabaseSourceCodeRoot, NoSuchSourceError, SourceCodeError
+from anthill.common.options import options
+
+from . cache import ExpiringCache
+from .. import options as _opts
 
 
 class JavascriptSourceError(Exception):
@@ -18,6 +22,7 @@ class JavascriptSourcesModel(Model, DatabaseSourceCodeRoot):
         self.db = db
         Model.__init__(self)
         DatabaseSourceCodeRoot.__init__(self, self.db, "exec")
+        self.server_sources = ExpiringCache(ttl=options.js_server_source_cache_ttl)
 
     def get_setup_db(self):
         return self.db
@@ -41,9 +46,16 @@ class JavascriptSourcesModel(Model, DatabaseSourceCodeRoot):
     @validate(gamespace_id="int")
     async def get_server_source(self, gamespace_id):
         try:
-            result = await self.get_server_commit(gamespace_id)
+            result = await self.server_sources.get(gamespace_id, self.get_server_commit, gamespace_id)
         except SourceCodeError as e:
             raise JavascriptSourceError(e.code, e.message)
         except NoSuchSourceError:
             raise JavascriptSourceError(404, "No default source")
         return result
+
+    def invalidate_server_source(self, gamespace_id):
+        """
+        Should be called once the Server Code settings or commit of the gamespace are changed,
+        other nodes will pick up the change once their cached copy expires
+        """
+        self.server_sources.invalidate(int(gamespace_id))
@@ -11,4 +11,134 @@ Error = function(code, message)
     this.code = code;
     this.message = message;
 }
+
+/*
+ * An async iterator over a cursor, that fetches items page by page. The cursor should have:
+ *   next() - a Promise of the next page (an array of items), or null once there is no more;
+ *   close() - to release the cursor early.
+ *
+ * for await (const item of new AsyncCursor(cursor)) { ... }
+ */
+AsyncCursor = function(cursor)
+{
+    this.cursor = cursor;
+    this.page = [];
+    this.position = 0;
+    this.done = false;
+}
+
+AsyncCursor.prototype.next = async function()
+{
+    while (this.position >= this.page.length)
+    {
+        if (this.done)
+        {
+            return {"done": true, "value": undefined};
+        }
+
+        var page = await this.cursor.next();
+
+        if (page === null || page === undefined)
+        {
+            this.close();
+        }
+        else
+        {
+            this.page = page;
+            this.position = 0;
+        }
+    }
+
+    return {"done": false, "value": this.page[this.position++]};
+}
+
+AsyncCursor.prototype.close = function()
+{
+    if (!this.done)
+    {
+        this.done = true;
+        this.page = [];
+        this.position = 0;
+        this.cursor.close();
+    }
+}
+
+// called once the for await loop is left early
+AsyncCursor.prototype.return = async function(value)
+{
+    this.close();
+    return {"done": true, "value": value};
+}
+
+if (typeof Symbol !== "undefined" && Symbol.asyncIterator)
+{
+    AsyncCursor.prototype[Symbol.asyncIterator] = function()
+    {
+        return this;
+    }
+}
+
+/*
+ * Binary data (like bodies of the HTTP responses, see web.request) is passed over to the script this way:
+ * an ArrayBuffer is allocated once, and base64-encoded chunks of the data are decoded into it one by one.
+ * Defined as a hidden read-only property, so the scripts cannot break it by accident.
+ */
+Object.defineProperty(this, "__binary__", {
+    "value": (function()
+    {
+        var alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+        var lookup = new Uint8Array(128);
+
+        for (var i = 0; i < alphabet.length; i++)
+        {
+            lookup[alphabet.charCodeAt(i)] = i;
+        }
+
+        return Object.freeze({
+            "allocate": function(length)
+            {
+                return new ArrayBuffer(length);
+            },
+
+            // decodes a base64 string into the buffer, starting at the offset
+            "write": function(buffer, offset, data)
+            {
+                var length = data.length;
+
+                while (length > 0 && data.charAt(length - 1) === "=")
+                {
+                    length--;
+                }
+
+                var bytes = new Uint8Array(buffer, offset, (length * 3) >> 2);
+                var position = 0;
+
+                for (var i = 0; i < length; i += 4)
+                {
+                    var a = lookup[data.charCodeAt(i)];
+                    var b = lookup[data.charCodeAt(i + 1)];
+                    var c = i + 2 < length ? lookup[data.charCodeAt(i + 2)] : 0;
+                    var d = i + 3 < length ? lookup[data.charCodeAt(i + 3)] : 0;
+
+                    bytes[position++] = (a << 2) | (b >> 4);
+
+                    if (i + 2 < length)
+                    {
+                        bytes[position++] = ((b & 15) << 4) | (c >> 2);
+                    }
+
+                    if (i + 3 < length)
+                    {
+                        bytes[position++] = ((c & 3) << 6) | d;
+                    }
+                }
+
+                return position;
+            }
+        });
+    })(),
+    "writable": false,
+    "enumerable": false,
+    "configurable": false
+});
 """
@@ -5,7 +5,9 @@ from tornado.gen import Future
 # noinspection PyUnresolvedReferences
 from v8py import JSFunction, new, JSPromise, JSException, current_context, JavaScriptTerminated
 
+import contextvars
 import weakref
+import sys
 import logging
 import traceback
 import asyncio
@@ -15,18 +17,82 @@ from anthill.common.internal import InternalError
 
 
 class JavascriptCallHandler(object):
-    def __init__(self, cache, env, context, debug=None, promise_type=None):
+    def __init__(self, cache, env, context, debug=None, promise_type=None, profile_cache=None,
+                 session_tasks=None, deadline=None):
         self.cache = cache
+        # time the call should be complete by (if limited), the requests made on its behalf respect it
+        self.deadline = deadline
+        # tasks started on behalf of the call (see track)
+        self.tasks = set()
+        self.session_tasks = session_tasks
+        # a cache of the account's profile, sessions have one (see ProfileCache)
+        self.profile_cache = profile_cache
+        # the call has changed the account's profile, so it should not share reads started before that
+        self.profile_written = False
         self.context = context
         self.env = env
         self.log = JavascriptCallHandler._default_log
         self.debug = debug
         self.promise_type = promise_type
+        self.deferred = []
 
     @staticmethod
     def _default_log(message):
         logging.info(message)
 
+    def defer(self, future, flush, *args):
+        """
+        Declares an operation the call has deferred (for example, a profile update, see ProfileWriter):
+        the call is not complete until the future is done. If the future is not done by then,
+        flush(*args) is awaited to speed it up.
+        """
+        self.deferred.append((future, flush, args))
+
+    async def flush(self):
+        """
+        Completes the operations deferred during the call, raises the first error if any of them has failed
+        """
+        while self.deferred:
+            deferred, self.deferred = self.deferred, []
+
+            flushes = []
+            for future, flush, args in deferred:
+                if not future.done() and (flush, args) not in flushes:
+                    flushes.append((flush, args))
+
+            for flush, args in flushes:
+                await flush(*args)
+
+            for future, flush, args in deferred:
+                await future
+
+    def track(self, task):
+        """
+        Remembers a task started on behalf of the call, until it's done. If the call has a session,
+        the session remembers the task too.
+        """
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        if self.session_tasks is not None:
+            self.session_tasks.add(task)
+            task.add_done_callback(self.session_tasks.discard)
+
+    def cancel(self):
+        """
+        Cancels the tasks of the call that are still running, for example, once nobody waits for the call
+        """
+        cancel_tasks(self.tasks)
+
+    def profile_changed(self, path=""):
+        """
+        Should be called by the APIs that (might) change the account's profile: forgets the profile cached
+        (everything above and below the path), and stops sharing the reads started before the change
+        """
+        self.profile_written = True
+        if self.profile_cache is not None:
+            self.profile_cache.invalidate(path)
+
     def get_cache(self, key):
         return self.cache.get(key) if self.cache is not None else None
 
@@ -35,11 +101,62 @@ class JavascriptCallHandler(object):
             self.cache[key] = value
 
 
+def cancel_tasks(tasks):
+    for task in list(tasks):
+        task.cancel()
+
+
+class LazyTraceback(object):
+    """
+    A traceback of an exception, that is formatted only once someone actually needs it as a string
+    (an error is shown to a debug client, or is logged), as formatting one is way too expensive
+    for the errors nobody is going to look at.
+
+    Keeps the traceback only, not the exception itself, so the exception can keep one without
+    a reference cycle.
+    """
+
+    __slots__ = ("tb", "formatted")
+
+    def __init__(self, tb):
+        self.tb = tb
+        self.formatted = None
+
+    def __str__(self):
+        if self.formatted is None:
+            self.formatted = "".join(traceback.format_tb(self.tb))
+            # no need to keep the frames alive anymore
+            self.tb = None
+        return self.formatted
+
+
+def keep_traceback(exc):
+    """
+    Remembers the traceback of an exception a promise is rejected with, as its `stack` (a string).
+    APIError formats it only once the stack is read (see APIError.stack), others are formatted right away.
+    """
+    if isinstance(exc, APIError):
+        exc._traceback = LazyTraceback(exc.__traceback__)
+    else:
+        exc.stack = "".join(traceback.format_tb(exc.__traceback__))
+
+
 class JavascriptExecutionError(Exception):
     def __init__(self, code, message, stack=None):
         self.code = code
         self.message = message
-        self.traceback = stack or (traceback.format_exc() if options.debug else None)
+
+        if stack is None and options.debug:
+            exc = sys.exc_info()[1]
+            if exc is not None:
+                stack = LazyTraceback(exc.__traceback__)
+
+        # a string, or a LazyTraceback
+        self._traceback = stack
+
+    @property
+    def traceback(self):
+        return str(self._traceback) if self._traceback is not None else None
 
     def __str__(self):
         return str(self.code) + ": " + str(self.message)
@@ -49,16 +166,17 @@ def process_error(e):
     if isinstance(e, JSException):
         value = e.value
         if hasattr(value, "code"):
-            if hasattr(value, "stack"):
-                raise JavascriptExecutionError(value.code, value.message, stack=str(value.stack))
+            stack = getattr(value, "stack", None)
+            if stack is not None:
+                return JavascriptExecutionError(value.code, value.message, stack=str(stack))
             else:
-                raise JavascriptExecutionError(value.code, value.message)
+                return JavascriptExecutionError(value.code, value.message)
         if hasattr(e, "stack"):
             return JavascriptExecutionError(500, str(e), stack=str(e.stack))
         return JavascriptExecutionError(500, str(e))
 
     if isinstance(e, APIError):
-        return JavascriptExecutionError(e.code, e.message, stack=str(e.stack) if hasattr(e, "stack") else None)
+        return JavascriptExecutionError(e.code, e.message, stack=getattr(e, "_traceback", None))
 
     if isinstance(e, InternalError):
         return JavascriptExecutionError(
@@ -70,7 +188,7 @@ def process_error(e):
                  "blocking and should rely on async methods instead.")
 
     code = e.code if hasattr(e, "code") else 500
-    stack = e.stack if hasattr(e, "stack") else None
+    stack = getattr(e, "stack", None)
     message = e.message if hasattr(e, "message") else str(e)
 
     return JavascriptExecutionError(code, message, stack=stack)
@@ -85,6 +203,7 @@ class APIError(Exception):
     def __init__(self, _code, _message):
         self._code = _code
         self._message = _message
+        self._traceback = None
         self.args = [_code, _message]
 
     @property
@@ -95,12 +214,20 @@ class APIError(Exception):
     def message(self):
         return self._message
 
+    @property
+    def stack(self):
+        return str(self._traceback) if self._traceback is not None else None
+
     def __str__(self):
         return str(self.code) + ": " + str(self.message)
 
 
 class PromiseContext(object):
-    current = None
+    """
+    Keeps the handler of the javascript call the code is running on behalf of.
+    It's a context variable, so the tasks a call starts see the handler of that very call.
+    """
+    current = contextvars.ContextVar("promise_context", default=None)
 
 
 class CompletedDeferred(object):
@@ -137,34 +264,34 @@ class APIUserError(APIError):
         super(APIUserError, self).__init__(code, message)
 
 
-def promise_completion(f):
-    handler = f.bound.handler()
+def promise_completion(bound, task):
+    """
+    Resolves the promise right away, as the task is complete: the done callbacks of a task
+    are called by the loop already, so there's no need to wait any longer
+    """
+    handler = bound()
+    resolve, reject = bound.resolve, bound.reject
+    bound.resolve = bound.reject = None
 
-    if handler is None:
+    # the call has been abandoned, there's nobody to resolve it for
+    if handler is None or task.cancelled():
         return
 
-        # once the future done, set the handler to ours
-    PromiseContext.current = handler
+    # the promise is resolved on behalf of the call that has created it
+    # (the callback runs in a copy of the context, so nothing leaks outside)
+    PromiseContext.current.set(handler)
 
-    exception = f.exception()
+    exception = task.exception()
     if exception:
-        exception.stack = "".join(traceback.format_tb(f.exc_info()[2]))
-        f.bound_reject(exception)
+        keep_traceback(exception)
+        reject(exception)
     else:
-        f.bound_resolve(f.result())
-
-    # reset it back
-    PromiseContext.current = None
-
-    del f.bound
-    del f.bound_reject
-    del f.bound_resolve
-    del f
+        resolve(task.result())
 
 
 def promise_callback(bound, resolve, reject):
 
-    handler = bound.handler()
+    handler = bound()
 
     if handler is None:
         return
@@ -173,21 +300,38 @@ def promise_callback(bound, resolve, reject):
         # noinspection PyProtectedMember
         coroutine_object = bound.method(*bound.args, handler=handler)
     except BaseException as exc:
-        exc.stack = traceback.format_exc()
+        keep_traceback(exc)
         reject(exc)
     else:
-        task = asyncio.ensure_future(coroutine_object)
-        task.bound = bound
-        task.bound_resolve = resolve
-        task.bound_reject = reject
-        task.add_done_callback(promise_completion)
+        bound.resolve = resolve
+        bound.reject = reject
+
+        # the task runs in a copy of the current context, so it's attributed to the call
+        task = asyncio.get_event_loop().create_task(coroutine_object)
+        task.add_done_callback(bound.complete)
+        handler.track(task)
 
 
-class BoundPromise(object):
+class BoundPromise(weakref.ref):
+    """
+    A weak reference to the handler of a call (so the promises do not keep an abandoned call alive),
+    along with the method the promise is made for
+    """
+
+    __slots__ = ("method", "args", "resolve", "reject")
+
+    def __new__(cls, handler, method, args):
+        return super(BoundPromise, cls).__new__(cls, handler)
+
     def __init__(self, handler, method, args):
-        self.handler = weakref.ref(handler)
+        super(BoundPromise, self).__init__(handler)
         self.method = method
         self.args = args
+        self.resolve = None
+        self.reject = None
+
+    def complete(self, task):
+        promise_completion(self, task)
 
 
 def promise(method):
@@ -211,7 +355,7 @@ def promise(method):
     """
     def wrapper(*args, **kwargs):
         # pull a handler from PromiseContext. every javascript call has to set one
-        handler = PromiseContext.current
+        handler = PromiseContext.current.get()
         context = handler.context
 
         return new(handler.promise_type, context.bind(promise_callback, BoundPromise(handler, method, args)))
@@ -0,0 +1,286 @@
+
+from tornado.httpclient import HTTPResponse, HTTPError
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.netutil import Resolver, DefaultExecutorResolver
+from tornado.locks import Semaphore
+
+from anthill.common.options import options
+from anthill.common import singleton
+
+from . cache import SingleFlight
+from .. import options as _opts
+
+from urllib.parse import urlsplit
+from io import BytesIO
+
+import logging
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
+
+try:
+    # noinspection PyProtectedMember
+    from tornado.simple_httpclient import _HTTPConnection
+except ImportError:
+    _HTTPConnection = None
+
+
+# StreamingConnection relies on the simple client's internals (checked against tornado 5.1 and 6),
+# if those are not there, the streamed responses are fetched as a whole first, see WebClient.fetch
+STREAMING_SUPPORTED = _HTTPConnection is not None and all(
+    hasattr(_HTTPConnection, name)
+    for name in ("data_received", "_should_follow_redirect", "_handle_exception")
+) and hasattr(SimpleAsyncHTTPClient, "_connection_class")
+
+# a response that has been fetched as a whole is passed to the streaming callback in chunks of this size
+BUFFERED_CHUNK_SIZE = 65536
+
+
+class CachingResolver(Resolver):
+    """
+    Keeps resolved addresses for `ttl` seconds, so each request to the same host does not go to DNS
+    """
+
+    # noinspection PyMethodOverriding
+    def initialize(self, resolver=None, ttl=60):
+        self.resolver = resolver or DefaultExecutorResolver()
+        self.ttl = ttl
+        self.addresses = {}
+        self.flights = SingleFlight()
+
+    def close(self):
+        self.resolver.close()
+
+    async def resolve(self, host, port, family=0):
+        key = (host, port, family)
+
+        cached = self.addresses.get(key)
+        if cached is not None:
+            addresses, expires_at = cached
+            if time.time() < expires_at:
+                return addresses
+
+        return await self.flights.run(key, self.__resolve__, key, host, port, family)
+
+    async def __resolve__(self, key, host, port, family):
+        addresses = await self.resolver.resolve(host, port, family)
+        self.addresses[key] = (addresses, time.time() + self.ttl)
+        return addresses
+
+
+class HostStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        # amount of requests that had to wait because of the per-host limit
+        self.throttled = 0
+        self.total_time = 0
+        self.bytes_received = 0
+
+    def dump(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "throttled": self.throttled,
+            "avg_time": (self.total_time / self.requests) if self.requests else 0,
+            "bytes_received": self.bytes_received
+        }
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+class StreamAborted(HTTPError):
+    def __init__(self):
+        super(StreamAborted, self).__init__(599, "The response has been aborted")
+
+
+class StreamingConnection(_HTTPConnection or object):
+    """
+    Same as the simple client's connection, except that the streaming callback could return a Future,
+    and the rest of the body is not read until the Future is resolved. If the callback (or the Future)
+    results in False, the request is aborted with StreamAborted, the same way it's aborted upon a timeout.
+    """
+
+    def data_received(self, chunk):
+        if self._should_follow_redirect():
+            return
+        if self.request.streaming_callback is None:
+            self.chunks.append(chunk)
+            return
+
+        result = self.request.streaming_callback(chunk)
+        if result is False:
+            self.abort()
+        elif result is not None:
+            return self.__wait__(result)
+
+    async def __wait__(self, future):
+        if (await future) is False:
+            self.abort()
+
+    def abort(self):
+        self._handle_exception(StreamAborted, StreamAborted(), None)
+
+
+class StreamingHTTPClient(SimpleAsyncHTTPClient):
+    """
+    The simple client that lets the streaming callback pause or abort the response, see StreamingConnection
+    """
+
+    def _connection_class(self):
+        return StreamingConnection
+
+
+class WebClient(object, metaclass=singleton.Singleton):
+    """
+    A shared HTTP client for the requests the javascript makes to the outside world.
+
+    Uses libcurl (keeps the connections alive, and caches DNS itself) if pycurl is installed, otherwise
+    the simple client with a caching resolver. Limits amount of concurrent requests to each host,
+    the bodies are received in chunks and are limited in size.
+
+    The streamed requests always go through the simple client, as libcurl cannot be paused or aborted
+    from the streaming callback. If this tornado's simple client cannot be extended for that
+    (see STREAMING_SUPPORTED), there is no stream_client, and such responses are fetched as a whole
+    (still limited by max_body_size) before being passed to the callback.
+    """
+
+    def __init__(self):
+        max_clients = options.js_web_max_clients
+        resolver = CachingResolver(ttl=options.js_web_dns_cache_ttl)
+
+        if STREAMING_SUPPORTED:
+            self.stream_client = StreamingHTTPClient(
+                force_instance=True, max_clients=max_clients, resolver=resolver)
+        else:
+            self.stream_client = None
+
+        if CurlAsyncHTTPClient is not None:
+            self.http_client = CurlAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        elif self.stream_client is not None:
+            self.http_client = self.stream_client
+        else:
+            self.http_client = SimpleAsyncHTTPClient(
+                force_instance=True, max_clients=max_clients, resolver=resolver)
+
+        self.max_requests_per_host = options.js_web_max_requests_per_host
+        self.max_body_size = options.js_web_max_body_size
+        self.limits = {}
+        self.hosts = {}
+
+    def __host__(self, host):
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = HostStats()
+            self.hosts[host] = stats
+            self.limits[host] = Semaphore(self.max_requests_per_host)
+        return stats
+
+    def stats(self):
+        return {
+            "client": self.http_client.__class__.__name__,
+            "hosts": {
+                host: stats.dump()
+                for host, stats in self.hosts.items()
+            }
+        }
+
+    async def fetch(self, request, raise_error=True, max_body_size=None, streaming_callback=None):
+        """
+        Same as AsyncHTTPClient.fetch, but a response with a body larger than max_body_size
+        (js_web_max_body_size by default) is raised ResponseTooLarge upon.
+
+        If streaming_callback is passed, the body is passed to it chunk by chunk, instead of being
+        collected into the response. The callback could return a Future to pause the response until it's
+        resolved, or return False (or resolve the Future with False) to abort it, see StreamingConnection.
+        Without a stream_client the body is collected first, and then passed to the callback the same way.
+        """
+
+        host = urlsplit(request.url).netloc.lower()
+        stats = self.__host__(host)
+        limit = self.limits[host]
+        max_body_size = max_body_size or self.max_body_size
+
+        chunks = BytesIO()
+        state = {"size": 0, "too_large": False}
+
+        streamed = streaming_callback is not None and self.stream_client is not None
+
+        def receive(chunk):
+            if state["too_large"]:
+                return
+            state["size"] += len(chunk)
+            if state["size"] > max_body_size:
+                state["too_large"] = True
+                chunks.close()
+                if streamed:
+                    # no point in receiving the rest of a stream
+                    return False
+                return
+            if streamed:
+                return streaming_callback(chunk)
+            chunks.write(chunk)
+
+        request.streaming_callback = receive
+        http_client = self.stream_client if streamed else self.http_client
+
+        if stats.in_flight >= self.max_requests_per_host:
+            stats.throttled += 1
+
+        async with limit:
+            stats.requests += 1
+            stats.in_flight += 1
+            started_at = time.time()
+
+            try:
+                response = await http_client.fetch(request, raise_error=False)
+            finally:
+                stats.in_flight -= 1
+                stats.total_time += time.time() - started_at
+                stats.bytes_received += state["size"]
+
+        if state["too_large"]:
+            stats.errors += 1
+            raise ResponseTooLarge("Response body is larger than {0} bytes".format(max_body_size))
+
+        if response.code == 599 or (raise_error and response.error):
+            stats.errors += 1
+            logging.debug("Request to {0} failed: {1}".format(host, str(response.error)))
+            response.rethrow()
+
+        if streaming_callback is not None and not streamed:
+            await WebClient.__replay__(chunks, streaming_callback)
+            chunks = BytesIO()
+
+        # the body went to the streaming callback, put it back (as is, without copying)
+        chunks.seek(0)
+        return HTTPResponse(
+            response.request, response.code, reason=response.reason, headers=response.headers,
+            buffer=chunks, effective_url=response.effective_url,
+            error=response.error, request_time=response.request_time)
+
+    @staticmethod
+    async def __replay__(body, streaming_callback):
+        """
+        Passes a body that has been fetched as a whole to the streaming callback, honoring a pause
+        or an abort the same way StreamingConnection does
+        """
+
+        view = body.getbuffer()
+        try:
+            for offset in range(0, len(view), BUFFERED_CHUNK_SIZE):
+                result = streaming_callback(bytes(view[offset:offset + BUFFERED_CHUNK_SIZE]))
+                if result is not None and result is not False:
+                    result = await result
+                if result is False:
+                    raise StreamAborted()
+        finally:
+            view.release()
@@ -77,3 +77,180 @@ define("js_call_timeout",
        default=10,
        help="Maximum time limit for each script execution",
        type=int)
+
+define("js_server_source_cache_ttl",
+       default=10,
+       help="Time (in seconds) a Server Code source of a gamespace is cached in-process",
+       type=int)
+
+define("gamespace_cache_ttl",
+       default=300,
+       help="Time (in seconds) a gamespace name lookup is cached in-process",
+       type=int)
+
+define("gamespace_negative_cache_ttl",
+       default=5,
+       help="Time (in seconds) a lookup of a gamespace that does not exist is cached in-process",
+       type=int)
+
+define("js_git_max_parallel_operations",
+       default=4,
+       help="Maximum number of git clones/checkouts run in parallel, the rest are queued",
+       type=int)
+
+define("js_build_artifact_ttl",
+       default=604800,
+       help="Time (in seconds) a precompiled build artifact is kept in the cache since it was last used",
+       type=int)
+
+define("js_api_max_requests_per_service",
+       default=256,
+       help="Maximum number of concurrent requests the javascript APIs may make to each service",
+       type=int)
+
+define("js_api_cache_ttl",
+       default=60,
+       help="Time (in seconds) the results of config/store APIs are considered fresh, "
+            "once expired, they are refreshed in the background",
+       type=int)
+
+define("js_api_local_cache_ttl",
+       default=10,
+       help="Time (in seconds) the in-process cache of config/store APIs trusts its copy, "
+            "before checking it against the shared cache in the background",
+       type=int)
+
+define("js_api_cache_max_stale",
+       default=300,
+       help="Maximum age (in seconds) of a stale config/store API result that is still served "
+            "while it is being refreshed",
+       type=int)
+
+define("js_api_batch_window",
+       default=0,
+       help="Time (in milliseconds) the batched API requests (like message.send_batch) are collected for, "
+            "before being sent together. 0 means the requests issued within the same loop iteration only.",
+       type=int)
+
+define("js_api_batch_max_size",
+       default=100,
+       help="Maximum amount of API requests being sent together in a single batch",
+       type=int)
+
+define("js_profile_update_window",
+       default=200,
+       help="Time (in milliseconds) the deferred profile updates (profile.update_deferred) are kept pending "
+            "to be merged together, unless the call that has made them is complete earlier",
+       type=int)
+
+define("js_session_profile_cache_ttl",
+       default=0,
+       help="Time (in seconds) a session keeps the account's profile it has read, "
+            "0 to disable. Changes made outside of the scripts API are not seen until it expires",
+       type=int)
+
+define("js_profile_get_many_parallel",
+       default=4,
+       help="Maximum amount of parallel requests a single profile.get_many call makes "
+            "(each one gets up to 1000 profiles)",
+       type=int)
+
+define("js_profile_scan_limit",
+       default=1000,
+       help="Maximum amount of results a single profile.scan fetches (at once, same as profile.query)",
+       type=int)
+
+define("js_message_queue_window",
+       default=50,
+       help="Time (in milliseconds) the messages sent with message.send are queued for, "
+            "before being sent together",
+       type=int)
+
+define("js_message_queue_max_size",
+       default=500,
+       help="Maximum amount of messages sent with message.send that are sent together",
+       type=int)
+
+define("js_web_cache_max_bytes",
+       default=16777216,
+       help="Maximum total size (in bytes) of the responses web.get keeps in its cache",
+       type=int)
+
+define("js_web_cache_max_entry_bytes",
+       default=1048576,
+       help="Maximum size (in bytes) of a response web.get would keep in its cache",
+       type=int)
+
+define("js_web_max_clients",
+       default=100,
+       help="Maximum amount of concurrent HTTP requests (web API) this node makes",
+       type=int)
+
+define("js_web_max_requests_per_host",
+       default=16,
+       help="Maximum amount of concurrent HTTP requests (web API) to a single host",
+       type=int)
+
+define("js_web_dns_cache_ttl",
+       default=60,
+       help="Time (in seconds) the resolved addresses of the hosts (web API) are cached for",
+       type=int)
+
+define("js_web_max_body_size",
+       default=10485760,
+       help="Maximum size (in bytes) of a HTTP response body (web API)",
+       type=int)
+
+define("js_web_max_timeout",
+       default=30,
+       help="Maximum time (in seconds) a single HTTP request (web API) can take",
+       type=int)
+
+define("js_web_max_stream_size",
+       default=104857600,
+       help="Maximum size (in bytes) of a HTTP response body streamed with web.stream",
+       type=int)
+
+define("js_web_stream_buffer_size",
+       default=1048576,
+       help="Amount of bytes of a response streamed with web.stream that could wait for the script to take "
+            "them, the response is paused once there are more",
+       type=int)
+
+define("js_api_breaker_window",
+       default=30,
+       help="Time window (in seconds) the circuit breakers of the services (used by the APIs) consider",
+       type=int)
+
+define("js_api_breaker_min_requests",
+       default=20,
+       help="Minimum amount of requests to a service within the window before its circuit breaker could open",
+       type=int)
+
+define("js_api_breaker_error_rate",
+       default=50,
+       help="Percentage of failed (or too slow) requests to a service within the window, "
+            "that opens its circuit breaker",
+       type=int)
+
+define("js_api_breaker_slow_call_time",
+       default=4,
+       help="Time (in seconds) a request to a service is considered failed after, as far as the circuit "
+            "breaker is concerned",
+       type=int)
+
+define("js_api_breaker_cooldown",
+       default=10,
+       help="Time (in seconds) a circuit breaker is kept open, before the service is probed again",
+       type=int)
+
+define("js_api_hedge_percentile",
+       default=95,
+       help="Percentile of the latencies of a latency-critical API request (like config.get), "
+            "after which an identical (hedged) request is sent",
+       type=int)
+
+define("js_api_hedge_budget",
+       default=5,
+       help="Maximum percentage of the latency-critical API requests that could be hedged",
+       type=int)
@@ -6,6 +6,7 @@ from anthill.common import access, server, database, keyvalue
 
 from . model.sources import JavascriptSourcesModel
 from . model.build import JavascriptBuildsModel
+from . model.cache import ExpiringCache
 
 from anthill.common.options import options
 from . import options as _opts
@@ -28,7 +29,11 @@ class ExecServer(server.Server):
             max_connections=options.cache_max_connections)
 
         self.sources = JavascriptSourcesModel(db)
-        self.builds = JavascriptBuildsModel(options.js_source_path, self.sources)
+        self.builds = JavascriptBuildsModel(options.js_source_path, self.sources, self.cache)
+
+        # gamespace name -> gamespace info, to resolve the Server Code calls without a round trip
+        self.gamespaces = ExpiringCache(
+            ttl=options.gamespace_cache_ttl, negative_ttl=options.gamespace_negative_cache_ttl)
 
     def get_models(self):
         return [self.sources, self.builds]
@@ -44,7 +49,8 @@ class ExecServer(server.Server):
             "app_version": admin.ApplicationVersionController,
             "app_settings": admin.ApplicationSettingsController,
             "server": admin.ServerCodeController,
-            "server_settings": admin.ServerCodeSettingsController
+            "server_settings": admin.ServerCodeSettingsController,
+            "status": admin.StatusController
         }
 
     def get_metadata(self):
@@ -0,0 +1,58 @@
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from .. model.artifacts import BuildArtifacts
+
+from anthill.common import keyvalue, random_string
+from anthill.common.options import options
+from .. import options as _opts
+
+
+class ArtifactsTestCase(AsyncTestCase):
+    def setUp(self):
+        super(ArtifactsTestCase, self).setUp()
+
+        self.kv = keyvalue.KeyValueStorage(
+            host=options.cache_host,
+            port=options.cache_port,
+            db=options.cache_db,
+            max_connections=4)
+
+        self.repository_url = "https://example.com/" + random_string(16) + ".git"
+
+    @gen_test
+    async def test_round_trip(self):
+        artifacts = BuildArtifacts(self.kv, ttl=60)
+        bundle = [["b.js", "function b() {}"], ["a.js", "function a() { return b(); }"]]
+
+        self.assertIsNone(await artifacts.get(self.repository_url, "abcdef"))
+
+        await artifacts.put(self.repository_url, "abcdef", bundle)
+
+        # the order of the files is preserved
+        self.assertEqual(await artifacts.get(self.repository_url, "abcdef"), bundle)
+        self.assertIsNone(await artifacts.get(self.repository_url, "fedcba"))
+        self.assertIsNone(await artifacts.get(self.repository_url + "2", "abcdef"))
+
+    @gen_test
+    async def test_ttl_refresh(self):
+        artifacts = BuildArtifacts(self.kv, ttl=60)
+        await artifacts.put(self.repository_url, "abcdef", [["a.js", ""]])
+
+        key = BuildArtifacts.__key__(self.repository_url, "abcdef")
+
+        async with self.kv.acquire() as db:
+            await db.expire(key, 5)
+
+        # an artifact being used is kept for the full ttl again
+        self.assertEqual(await artifacts.get(self.repository_url, "abcdef"), [["a.js", ""]])
+
+        async with self.kv.acquire() as db:
+            self.assertGreater(await db.ttl(key), 5)
+
+    @gen_test
+    async def test_no_storage(self):
+        artifacts = BuildArtifacts(None)
+
+        await artifacts.put(self.repository_url, "abcdef", [["a.js", ""]])
+        self.assertIsNone(await artifacts.get(self.repository_url, "abcdef"))
@@ -0,0 +1,201 @@
+
+from tornado.gen import sleep, multi
+from tornado.testing import AsyncTestCase, gen_test
+
+from .. model.cache import SingleFlight, ExpiringCache, TwoTierCache, HTTPResponseCache
+
+import asyncio
+
+
+class CacheTestCase(AsyncTestCase):
+
+    @gen_test
+    async def test_single_flight(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def resolve(value):
+            calls.append(value)
+            await sleep(0.1)
+            return value * 2
+
+        res = await multi([flights.run("a", resolve, 1) for _ in range(0, 10)])
+
+        self.assertEqual(res, [2] * 10)
+        self.assertEqual(calls, [1])
+        self.assertFalse("a" in flights)
+
+    @gen_test
+    async def test_single_flight_error(self):
+        flights = SingleFlight()
+
+        async def resolve():
+            await sleep(0.1)
+            raise ValueError("bad_idea")
+
+        for _ in range(0, 2):
+            with self.assertRaises(ValueError):
+                await multi([flights.run("a", resolve) for _ in range(0, 5)])
+
+    @gen_test
+    async def test_single_flight_cancel(self):
+        flights = SingleFlight()
+
+        async def resolve():
+            await sleep(0.1)
+            return 1
+
+        first = asyncio.ensure_future(flights.run("a", resolve))
+        second = asyncio.ensure_future(flights.run("a", resolve))
+        await sleep(0.01)
+
+        first.cancel()
+        self.assertEqual(await second, 1)
+        self.assertTrue(first.cancelled())
+
+    @gen_test
+    async def test_expiring_cache(self):
+        cache = ExpiringCache(ttl=1)
+        calls = []
+
+        async def resolve(key):
+            calls.append(key)
+            return {}
+
+        self.assertEqual(await cache.get("a", resolve, "a"), {})
+        self.assertEqual(await cache.get("a", resolve, "a"), {})
+        self.assertEqual(calls, ["a"])
+
+        cache.invalidate("a")
+        await cache.get("a", resolve, "a")
+        self.assertEqual(calls, ["a", "a"])
+
+        await sleep(1.1)
+        await cache.get("a", resolve, "a")
+        self.assertEqual(calls, ["a", "a", "a"])
+
+    @gen_test
+    async def test_expiring_cache_missing(self):
+        calls = []
+
+        async def resolve(key):
+            calls.append(key)
+            return None
+
+        # nothing found is not cached at all by default
+        cache = ExpiringCache(ttl=60)
+        self.assertIsNone(await cache.get("a", resolve, "a"))
+        self.assertIsNone(await cache.get("a", resolve, "a"))
+        self.assertEqual(calls, ["a", "a"])
+
+        # or is cached for a short while
+        del calls[:]
+        cache = ExpiringCache(ttl=60, negative_ttl=1)
+        self.assertIsNone(await cache.get("a", resolve, "a"))
+        self.assertIsNone(await cache.get("a", resolve, "a"))
+        self.assertEqual(calls, ["a"])
+
+        await sleep(1.1)
+        self.assertIsNone(await cache.get("a", resolve, "a"))
+        self.assertEqual(calls, ["a", "a"])
+
+    @gen_test
+    async def test_two_tier_cache(self):
+        cache = TwoTierCache("test", local_ttl=1)
+        calls = []
+
+        async def resolve(key):
+            calls.append(key)
+            await sleep(0.1)
+            return {}
+
+        res = await multi([cache.get("a", resolve, "a") for _ in range(0, 5)])
+        self.assertEqual(res, [{}] * 5)
+        self.assertEqual(calls, ["a"])
+
+        self.assertEqual(await cache.get("a", resolve, "a"), {})
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    @gen_test
+    async def test_stale_while_revalidate(self):
+        cache = TwoTierCache("test", ttl=0.5, local_ttl=0.5, max_stale=2)
+        calls = []
+
+        async def resolve():
+            calls.append(len(calls))
+            await sleep(0.2)
+            return len(calls)
+
+        self.assertEqual(await cache.get("a", resolve), 1)
+        await sleep(0.6)
+
+        # the stale value is returned at once, while the refresh is in progress
+        self.assertEqual(await cache.get("a", resolve), 1)
+        self.assertEqual(await cache.get("a", resolve), 1)
+        await sleep(0.3)
+
+        self.assertEqual(await cache.get("a", resolve), 2)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats()["stale_hits"], 2)
+
+        await sleep(2.1)
+
+        # way too old to be served
+        self.assertEqual(await cache.get("a", resolve), 3)
+
+    @gen_test
+    async def test_revalidate_tracked(self):
+        cache = TwoTierCache("test", ttl=0.1, local_ttl=0.1, max_stale=2)
+        tasks = set()
+        calls = []
+
+        async def resolve():
+            calls.append(len(calls))
+            await sleep(0.2)
+            return len(calls)
+
+        self.assertEqual(await cache.get("a", resolve, track=tasks.add), 1)
+        self.assertEqual(tasks, set())
+        await sleep(0.2)
+
+        self.assertEqual(await cache.get("a", resolve, track=tasks.add), 1)
+        self.assertEqual(len(tasks), 1)
+
+        # the refresh is cancelled along with the call, while the shared lookup goes on
+        for task in tasks:
+            task.cancel()
+        await sleep(0.3)
+
+        self.assertEqual(await cache.get("a", resolve), 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_http_response_cache(self):
+        cache = HTTPResponseCache(max_bytes=10, max_entry_bytes=6)
+
+        self.assertNotEqual(
+            HTTPResponseCache.key("http://a", {"Accept": "text/plain"}),
+            HTTPResponseCache.key("http://a", {"Accept": "application/json"}))
+
+        self.assertIsNone(cache.put("a", {"Cache-Control": "no-store, max-age=60"}, b"aaaa"))
+        self.assertIsNone(cache.put("a", {}, b"aaaa"))
+        self.assertIsNone(cache.put("a", {"Cache-Control": "max-age=60"}, b"aaaaaaa"))
+
+        entry = cache.put("a", {"Cache-Control": "max-age=60"}, b"aaaa")
+        self.assertTrue(entry.fresh())
+        self.assertEqual(entry.validators(), {})
+
+        entry = cache.put("b", {"Cache-Control": "no-cache", "ETag": '"1"'}, b"bbbb")
+        self.assertFalse(entry.fresh())
+        self.assertEqual(entry.validators(), {"If-None-Match": '"1"'})
+
+        cache.revalidated("b", entry, {"Cache-Control": "max-age=60"})
+        self.assertTrue(entry.fresh())
+
+        # "a" is the least recently used one
+        cache.put("c", {"Expires": "Thu, 01 Jan 2099 00:00:00 GMT"}, b"cccc")
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertTrue(cache.get("c").fresh())
+        self.assertEqual(cache.size, 8)
@@ -0,0 +1,332 @@
+
+from tornado.gen import sleep, multi
+from tornado.testing import AsyncTestCase, gen_test
+
+from .. model.client import RequestBatcher, CircuitBreaker, LatencyTracker, HedgeBudget, APIClient
+from .. model.util import APIError
+from .. model.api import send_messages, APIBatches
+
+from anthill.common.internal import InternalError
+from anthill.common import singleton
+
+import asyncio
+import time
+
+
+class SlowService(object):
+    """
+    Stands for Internal: answers every request in `delay` seconds, unless the request times out sooner
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.timeouts = []
+        self.requests = []
+
+    async def request(self, service, method, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        self.requests.append((method, kwargs))
+
+        if timeout < self.delay:
+            await sleep(timeout)
+            raise InternalError(599, "Timeout")
+
+        await sleep(self.delay)
+        return {"method": method}
+
+
+class ClientTestCase(AsyncTestCase):
+
+    @gen_test
+    async def test_batch_flush_on_size(self):
+        flushes = []
+
+        async def flush(key, items):
+            flushes.append((key, list(items)))
+            return [item * 2 for item in items]
+
+        batcher = RequestBatcher(flush, window=10, max_size=3)
+
+        started_at = time.time()
+        res = await multi([batcher.add("a", i) for i in range(0, 3)])
+
+        # a full batch is not waiting for the window to pass
+        self.assertLess(time.time() - started_at, 1)
+        self.assertEqual(res, [0, 2, 4])
+        self.assertEqual(flushes, [("a", [0, 1, 2])])
+
+    @gen_test
+    async def test_batch_flush_on_delay(self):
+        flushes = []
+
+        async def flush(key, items):
+            flushes.append((key, list(items)))
+            return items
+
+        batcher = RequestBatcher(flush, window=0.2, max_size=100)
+
+        async def add_later(key, item, delay):
+            await sleep(delay)
+            return await batcher.add(key, item)
+
+        started_at = time.time()
+        res = await multi([
+            batcher.add("a", 1),
+            add_later("a", 2, 0.1),
+            batcher.add("b", 3)
+        ])
+
+        self.assertGreaterEqual(time.time() - started_at, 0.2)
+        self.assertEqual(res, [1, 2, 3])
+        self.assertEqual(sorted(flushes), [("a", [1, 2]), ("b", [3])])
+        self.assertEqual(batcher.stats()["batches"], 2)
+
+    @gen_test
+    async def test_batch_item_errors(self):
+
+        async def flush(key, items):
+            return [APIError(400, "bad_item") if item == "bad" else item for item in items]
+
+        batcher = RequestBatcher(flush)
+
+        good = asyncio.ensure_future(batcher.add("a", "good"))
+        bad = asyncio.ensure_future(batcher.add("a", "bad"))
+
+        self.assertEqual(await good, "good")
+
+        with self.assertRaises(APIError) as error:
+            await bad
+        self.assertEqual(error.exception.code, 400)
+        self.assertEqual(batcher.stats()["batches"], 1)
+
+    @gen_test
+    async def test_batch_error(self):
+
+        async def flush(key, items):
+            raise APIError(599, "timeout")
+
+        batcher = RequestBatcher(flush)
+        futures = [asyncio.ensure_future(batcher.add("a", i)) for i in range(0, 3)]
+
+        # every waiter gets the error of the batch
+        for future in futures:
+            with self.assertRaises(APIError) as error:
+                await future
+            self.assertEqual(error.exception.code, 599)
+
+        self.assertEqual(batcher.stats()["batches"], 1)
+
+    @gen_test
+    async def test_queued_messages_timeout(self):
+        sent = []
+
+        async def send(key, messages):
+            sent.append(list(messages))
+            raise APIError(599, "timeout")
+
+        batcher = RequestBatcher(lambda key, items: send_messages(key, items, send), window=0.05)
+        futures = [asyncio.ensure_future(batcher.add("a", [i])) for i in range(0, 3)]
+
+        for future in futures:
+            with self.assertRaises(APIError) as error:
+                await future
+            self.assertEqual(error.exception.code, 599)
+
+        # the messages might have been delivered, so they are never sent again
+        self.assertEqual(sent, [[0, 1, 2]])
+
+    @gen_test
+    async def test_queued_messages_rejected(self):
+        sent = []
+
+        async def send(key, messages):
+            sent.append(list(messages))
+            if "bad" in messages:
+                raise APIError(400, "bad_message")
+            return "OK"
+
+        batcher = RequestBatcher(lambda key, items: send_messages(key, items, send), window=0.05)
+        good = asyncio.ensure_future(batcher.add("a", ["good"]))
+        bad = asyncio.ensure_future(batcher.add("a", ["bad"]))
+
+        self.assertEqual(await good, "OK")
+        with self.assertRaises(APIError):
+            await bad
+
+        # the batch has been rejected as a whole, so each one is sent on its own
+        self.assertEqual(sent, [["good", "bad"], ["good"], ["bad"]])
+
+    @staticmethod
+    def trip(breaker):
+        for _ in range(0, breaker.min_requests):
+            breaker.record(breaker.admit(), True, 0)
+
+    def test_breaker_opens(self):
+        breaker = CircuitBreaker("test", min_requests=4, error_rate=0.5, cooldown=10)
+
+        for failed in (False, True, False):
+            breaker.record(breaker.admit(), failed, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        breaker.record(breaker.admit(), True, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertIsNone(breaker.admit())
+
+    def test_breaker_slow_calls(self):
+        breaker = CircuitBreaker("test", min_requests=2, slow_call_time=1)
+
+        breaker.record(breaker.admit(), False, 0.5)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        breaker.record(breaker.admit(), False, 1.5)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_breaker_half_open(self):
+        breaker = CircuitBreaker("test", min_requests=2, cooldown=10, max_probes=1)
+        self.trip(breaker)
+
+        # cooldown is over
+        breaker.opened_at -= 10
+
+        probe = breaker.admit()
+        self.assertIsNotNone(probe)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertIsNone(breaker.admit())
+
+        breaker.record(probe, False, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.dump()["requests"], 0)
+
+    def test_breaker_probe_fails(self):
+        breaker = CircuitBreaker("test", min_requests=2, cooldown=10)
+        self.trip(breaker)
+        breaker.opened_at -= 10
+
+        breaker.record(breaker.admit(), True, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.trips, 2)
+        self.assertIsNone(breaker.admit())
+
+    def test_breaker_probe_abandoned(self):
+        breaker = CircuitBreaker("test", min_requests=2, cooldown=10, max_probes=1)
+        self.trip(breaker)
+        breaker.opened_at -= 10
+
+        breaker.abandon(breaker.admit())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        # the abandoned probe has given its place to another one
+        probe = breaker.admit()
+        self.assertIsNotNone(probe)
+        breaker.record(probe, False, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_breaker_stale_tickets(self):
+        breaker = CircuitBreaker("test", min_requests=2, cooldown=10, max_probes=1)
+
+        # sent before the breaker has opened, completes once it's half-open
+        late = breaker.admit()
+        self.trip(breaker)
+        breaker.opened_at -= 10
+
+        probe = breaker.admit()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        breaker.record(late, False, 0)
+        breaker.abandon(late)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.probes, 1)
+        self.assertIsNone(breaker.admit())
+
+        breaker.record(probe, True, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # and the ones from before do not count in the closed state either
+        breaker.opened_at -= 10
+        breaker.record(breaker.admit(), False, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        breaker.record(late, True, 0)
+        self.assertEqual(breaker.dump()["failures"], 0)
+
+    def test_latency_percentile(self):
+        latencies = LatencyTracker(size=100, min_samples=50)
+
+        for i in range(0, 49):
+            latencies.add((i + 1) / 100.0)
+
+        # not enough samples to tell
+        self.assertIsNone(latencies.percentile(90))
+
+        for i in range(49, 100):
+            latencies.add((i + 1) / 100.0)
+
+        self.assertAlmostEqual(latencies.percentile(90), 0.91)
+        self.assertAlmostEqual(latencies.percentile(50), 0.51)
+        self.assertAlmostEqual(latencies.percentile(100), 1.0)
+
+        # the oldest samples are pushed out, the percentiles follow (once the cache is reset)
+        for i in range(0, 96):
+            latencies.add(2.0)
+
+        self.assertAlmostEqual(latencies.percentile(50), 2.0)
+        self.assertAlmostEqual(latencies.percentile(1), 0.98)
+
+    def test_hedge_budget(self):
+        budget = HedgeBudget(ratio=0.25, max_tokens=2)
+
+        # not a single request has earned a whole token yet
+        for _ in range(0, 3):
+            budget.earn()
+        self.assertFalse(budget.spend())
+
+        budget.earn()
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+
+        # no matter how many requests are made, no more than max_tokens are saved up
+        for _ in range(0, 100):
+            budget.earn()
+
+        self.assertTrue(budget.spend())
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+
+    @gen_test
+    async def test_coalesced_deadlines(self):
+        singleton.Singleton.objects.pop(APIClient, None)
+        client = APIClient()
+        client.internal = SlowService(0.3)
+
+        now = time.time()
+        hurried = asyncio.ensure_future(client.request(
+            "profile", "get_my_profile", timeout=5, coalesce=True, deadline=now + 0.1, account=1))
+        patient = asyncio.ensure_future(client.request(
+            "profile", "get_my_profile", timeout=5, coalesce=True, deadline=now + 30, account=1))
+
+        # the caller that has started the request gives up on it at its own deadline
+        with self.assertRaises(APIError) as error:
+            await hurried
+        self.assertEqual(error.exception.code, 408)
+
+        # while the shared request itself is not limited by it
+        self.assertEqual(await patient, {"method": "get_my_profile"})
+        self.assertEqual(client.internal.timeouts, [5])
+        self.assertEqual(client.services["profile"].coalesced, 1)
+
+    @gen_test
+    async def test_group_profiles_path(self):
+        singleton.Singleton.objects.pop(APIClient, None)
+        client = APIClient()
+        client.internal = SlowService(0)
+
+        # the path is passed to the service as the script has passed it, not as a part of the key
+        await APIBatches.__update_group_profiles__(("1", None, True), [("10", {"a": 1})])
+        await APIBatches.__update_group_profiles__(("1", ("a", "b"), True), [("10", 1), ("11", 2)])
+
+        self.assertEqual(client.internal.requests, [
+            ("update_group_profile", {
+                "gamespace": "1", "group_id": "10", "profile": {"a": 1}, "path": None, "merge": True}),
+            ("update_group_profiles", {
+                "gamespace": "1", "group_profiles": {"10": 1, "11": 2}, "path": ["a", "b"], "merge": True})
+        ])
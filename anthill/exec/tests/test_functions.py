@@ -1,5 +1,7 @@
 from tornado.gen import sleep, multi
-from tornado.testing import gen_test
+from tornado.testing import gen_test, bind_unused_port
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, RequestHandler
 
 # noinspection PyUnresolvedReferences
 from v8py import JSException, Context, new
@@ -8,14 +10,19 @@ from .. server import ExecServer
 
 from .. model.build import JavascriptBuild, JavascriptBuildError, JavascriptSessionError
 from .. model.build import NoSuchClass, NoSuchMethod, JavascriptExecutionError
+from .. model.pipeline import CallPipeline, CallStage, JavascriptCall
+from .. model.util import JavascriptCallHandler, JSFuture, PromiseContext, APIError, keep_traceback
 
 from anthill.common.options import default
 from .. import options as _opts
 
 from anthill.common import random_string, testing
 
+import asyncio
 import hashlib
 import inspect
+import logging
+import time
 import re
 
 
@@ -26,6 +33,37 @@ def is_debugging():
     return False
 
 
+class LoopTicker(object):
+    """
+    Counts iterations of the loop, for as long as it's running
+    """
+
+    def __init__(self):
+        self.ticks = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        asyncio.get_event_loop().call_soon(self.__tick__)
+
+    def stop(self):
+        self.running = False
+        return self.ticks
+
+    def __tick__(self):
+        if self.running:
+            self.ticks += 1
+            asyncio.get_event_loop().call_soon(self.__tick__)
+
+
+class BinaryHandler(RequestHandler):
+    # larger than BINARY_CHUNK_SIZE, so it's passed over in a few chunks
+    BODY = bytes(range(256)) * 1024
+
+    def get(self):
+        self.write(BinaryHandler.BODY)
+
+
 class FunctionsTestCase(testing.ServerTestCase):
     @classmethod
     def need_test_db(cls):
@@ -342,6 +380,73 @@ class FunctionsTestCase(testing.ServerTestCase):
         await session.release()
         self.assertEqual(Obj.released, True)
 
+    @staticmethod
+    def expose_task_starter(build, tasks):
+        def start_task():
+            task = asyncio.ensure_future(sleep(10))
+            PromiseContext.current.get().track(task)
+            tasks.append(task)
+
+        build.context.expose(start_task)
+
+    @gen_test
+    async def test_timeout_cancels_tasks(self):
+        build = JavascriptBuild()
+        tasks = []
+        FunctionsTestCase.expose_task_starter(build, tasks)
+
+        build.add_source("""
+            async function main(args)
+            {
+                start_task();
+                await sleep(2);
+            }
+
+            main.allow_call = true;
+        """)
+
+        with self.assertRaises(APIError) as error:
+            await build.call("main", {}, call_timeout=0.5)
+
+        self.assertEqual(error.exception.code, 408)
+        await sleep(0)
+        self.assertEqual(len(tasks), 1)
+        self.assertTrue(tasks[0].cancelled())
+
+    @gen_test
+    async def test_session_release_cancels_tasks(self):
+        build = JavascriptBuild()
+        tasks = []
+        FunctionsTestCase.expose_task_starter(build, tasks)
+
+        build.add_source("""
+            function SessionTest()
+            {
+            }
+
+            SessionTest.prototype.start = function(args)
+            {
+                start_task();
+                return "started";
+            };
+
+            SessionTest.allow_session = true;
+        """)
+
+        session = build.session("SessionTest", {})
+        self.assertEqual(await session.call("start", {}), "started")
+        self.assertEqual(await session.call("start", {}), "started")
+
+        # the calls are complete, but what they have started goes on until the session is released
+        self.assertEqual(len(tasks), 2)
+        self.assertFalse(any(task.done() for task in tasks))
+        self.assertEqual(session.tasks, set(tasks))
+
+        await session.release()
+        await sleep(0)
+        self.assertTrue(all(task.cancelled() for task in tasks))
+        self.assertEqual(session.tasks, set())
+
     @gen_test
     async def test_session(self):
 
@@ -512,6 +617,46 @@ class FunctionsTestCase(testing.ServerTestCase):
 
         self.assertEqual(res, [True, True])
 
+    @gen_test
+    async def test_call_context(self):
+
+        build = JavascriptBuild()
+
+        build.add_source("""
+            function ContextTest()
+            {
+            }
+
+            ContextTest.prototype.main = async function(args)
+            {
+                log(args["name"] + "1");
+                await sleep(args["delay"]);
+                log(args["name"] + "2");
+                await Promise.all([moment(), sleep(args["delay"])]);
+                log(args["name"] + "3");
+            }
+
+            ContextTest.allow_session = true;
+        """)
+
+        logs = {"a": [], "b": []}
+
+        session_a = build.session("ContextTest", {}, log=logs["a"].append)
+        session_b = build.session("ContextTest", {}, log=logs["b"].append)
+
+        try:
+            # the calls are interleaved, but each one logs into its own session
+            await multi([
+                session_a.call("main", {"name": "a", "delay": 0.2}),
+                session_b.call("main", {"name": "b", "delay": 0.1})
+            ])
+        finally:
+            await session_a.release()
+            await session_b.release()
+
+        self.assertEqual(logs["a"], ["a1", "a2", "a3"])
+        self.assertEqual(logs["b"], ["b1", "b2", "b3"])
+
     @gen_test(timeout=1)
     async def test_parallel(self):
         """
@@ -593,3 +738,372 @@ class FunctionsTestCase(testing.ServerTestCase):
         await sleep(1.5)
 
         self.assertTrue(build.released)
+
+    @gen_test
+    async def test_async_cursor(self):
+        build = JavascriptBuild()
+
+        build.add_source("""
+            function pages(items, closed)
+            {
+                return {
+                    "next": async function()
+                    {
+                        return items.length ? items.shift() : null;
+                    },
+                    "close": function()
+                    {
+                        closed.push(true);
+                    }
+                };
+            }
+
+            async function main(args)
+            {
+                var closed = [];
+                var cursor = new AsyncCursor(pages([[1, 2], [], [3]], closed));
+                var sum = 0;
+
+                while (true)
+                {
+                    var next = await cursor.next();
+                    if (next.done)
+                        break;
+                    sum += next.value;
+                }
+
+                return [sum, closed.length];
+            }
+
+            async function stop(args)
+            {
+                var closed = [];
+                var cursor = new AsyncCursor(pages([[1, 2], [3]], closed));
+
+                var first = await cursor.next();
+                await cursor.return();
+                var next = await cursor.next();
+
+                return [first.value, next.done, closed.length];
+            }
+
+            main.allow_call = true;
+            stop.allow_call = true;
+        """)
+
+        self.assertEqual(await build.call("main", {}), [6, 1])
+        self.assertEqual(await build.call("stop", {}), [1, True, 1])
+
+    @gen_test(timeout=30)
+    async def test_promise_round_trips(self):
+        build = JavascriptBuild()
+
+        build.add_source("""
+            async function main(args)
+            {
+                for (var i = 0; i < args["count"]; i++)
+                    await moment();
+
+                var all = [];
+                for (var j = 0; j < args["count"]; j++)
+                    all.push(moment());
+                await Promise.all(all);
+
+                return args["count"];
+            }
+
+            main.allow_call = true;
+        """)
+
+        count = 10000
+        started_at = time.time()
+        self.assertEqual(await build.call("main", {"count": count}, call_timeout=30), count)
+        spent = time.time() - started_at
+
+        logging.info("Promise round trips: {0} in {1:.3f}s ({2:.0f}/s)".format(
+            count * 2, spent, count * 2 / spent))
+
+    @gen_test
+    async def test_promise_loop_iterations(self):
+        build = JavascriptBuild()
+
+        build.add_source("""
+            async function main(args)
+            {
+                for (var i = 0; i < args["count"]; i++)
+                    await moment();
+
+                return args["count"];
+            }
+
+            main.allow_call = true;
+        """)
+
+        async def bare_moment():
+            await asyncio.sleep(0)
+
+        count = 1000
+
+        # the very same thing without javascript: a task per await
+        ticker = LoopTicker()
+        ticker.start()
+        for i in range(0, count):
+            await asyncio.ensure_future(bare_moment())
+        bare = ticker.stop()
+
+        ticker = LoopTicker()
+        ticker.start()
+        self.assertEqual(await build.call("main", {"count": count}), count)
+        promised = ticker.stop()
+
+        # a promise is resolved as soon as its task is done, not a loop iteration later
+        # (a few iterations are spent by the call itself)
+        self.assertLessEqual(promised, bare + 10)
+
+    @gen_test
+    async def test_binary_response(self):
+        sock, port = bind_unused_port()
+        server = HTTPServer(Application([(r"/binary", BinaryHandler)]))
+        server.add_sockets([sock])
+
+        build = JavascriptBuild()
+
+        build.add_source("""
+            // the scripts cannot break the way binary data is passed over
+            __binary__ = null;
+
+            async function request(args)
+            {
+                var response = await web.request("GET", args["url"], null, null, 10, true);
+                var body = response.body;
+
+                return {
+                    "instance": body instanceof ArrayBuffer,
+                    "length": body.byteLength,
+                    "bytes": Array.from(new Uint8Array(body, 0, 256)),
+                    "sum": new Uint8Array(body).reduce(function(a, b) { return a + b; }, 0)
+                };
+            }
+
+            async function stream(args)
+            {
+                var instances = true;
+                var length = 0;
+
+                for await (const chunk of web.stream(args["url"], "GET", null, null, 10, true))
+                {
+                    instances = instances && (chunk instanceof ArrayBuffer);
+                    length += chunk.byteLength;
+                }
+
+                return {
+                    "instance": instances,
+                    "length": length
+                };
+            }
+
+            request.allow_call = true;
+            stream.allow_call = true;
+        """)
+
+        url = "http://127.0.0.1:{0}/binary".format(port)
+
+        try:
+            result = await build.call("request", {"url": url})
+            self.assertTrue(result["instance"])
+            self.assertEqual(result["length"], len(BinaryHandler.BODY))
+            self.assertEqual(result["bytes"], list(range(256)))
+            self.assertEqual(result["sum"], sum(BinaryHandler.BODY))
+
+            result = await build.call("stream", {"url": url})
+            self.assertTrue(result["instance"])
+            self.assertEqual(result["length"], len(BinaryHandler.BODY))
+        finally:
+            server.stop()
+
+    @gen_test(timeout=30)
+    async def test_error_round_trips(self):
+        build = JavascriptBuild()
+
+        build.add_source("""
+            async function main(args)
+            {
+                var failed = 0;
+
+                for (var i = 0; i < args["count"]; i++)
+                {
+                    try
+                    {
+                        await web.request("BREW", "http://localhost");
+                    }
+                    catch (e)
+                    {
+                        failed++;
+                    }
+                }
+
+                return failed;
+            }
+
+            main.allow_call = true;
+        """)
+
+        count = 10000
+        started_at = time.time()
+        self.assertEqual(await build.call("main", {"count": count}, call_timeout=30), count)
+        spent = time.time() - started_at
+
+        logging.info("Failed promise round trips: {0} in {1:.3f}s ({2:.0f}/s)".format(
+            count, spent, count / spent))
+
+    @gen_test
+    async def test_rejection_stack(self):
+        build = JavascriptBuild()
+
+        build.add_source("""
+            async function main(args)
+            {
+                try
+                {
+                    await web.request("BREW", "http://localhost");
+                }
+                catch (e)
+                {
+                    return {
+                        "code": e.code,
+                        "stack": typeof e.stack,
+                        "traceback": e.stack.indexOf("__new_request__") >= 0
+                    };
+                }
+            }
+
+            main.allow_call = true;
+        """)
+
+        self.assertEqual(await build.call("main", {}), {
+            "code": 400,
+            "stack": "string",
+            "traceback": True
+        })
+
+    def test_lazy_traceback(self):
+        def fail():
+            raise APIError(400, "bad_idea")
+
+        try:
+            fail()
+        except APIError as e:
+            keep_traceback(e)
+            error = e
+
+        # formatted on demand, but still a string
+        self.assertIsNotNone(error._traceback)
+        self.assertIsInstance(error.stack, str)
+        self.assertIn("in fail", error.stack)
+
+    @gen_test
+    async def test_call_pipeline(self):
+        build = JavascriptBuild()
+
+        build.add_source("""
+            function main(args)
+            {
+                return args["a"] + args["b"];
+            }
+
+            main.allow_call = true;
+        """)
+
+        calls = []
+
+        class TestStage(CallStage):
+            def before(self, call):
+                if call.args.get("a") == 0:
+                    raise JavascriptExecutionError(429, "Not now")
+                if call.args.get("a") == 1:
+                    call.complete(100)
+
+            def after(self, call):
+                calls.append((call.name, call.result, call.error is not None))
+
+        stage = TestStage()
+        CallPipeline().add_stage(stage)
+
+        try:
+            self.assertEqual(await build.call("main", {"a": 2, "b": 3}), 5)
+            self.assertEqual(await build.call("main", {"a": 1, "b": 3}), 100)
+
+            with self.assertRaises(JavascriptExecutionError) as error:
+                await build.call("main", {"a": 0, "b": 3})
+            self.assertEqual(error.exception.code, 429)
+        finally:
+            CallPipeline().remove_stage(stage)
+
+        # a rejected call does not reach the 'after' hook of the stage that has rejected it
+        self.assertEqual(calls, [("main", 5, False), ("main", 100, False)])
+        self.assertEqual(CallPipeline().stats.dump()[JavascriptCall.FUNCTION]["in_flight"], 0)
+
+    @gen_test(timeout=60)
+    async def test_call_overhead(self):
+        build = JavascriptBuild()
+
+        build.add_source("""
+            function main(args)
+            {
+                return args["a"] + args["b"];
+            }
+
+            main.allow_call = true;
+        """)
+
+        count = 5000
+        args = {"a": 1, "b": 2}
+
+        # the bare minimum any call needs, with no checks, stages or accounting at all
+        method = build.context.glob.main
+        started_at = time.time()
+        for _ in range(0, count):
+            handler = JavascriptCallHandler(None, {}, build.context, promise_type=build.promise_type)
+            future = build.context.async_call(method, (args,), JSFuture)
+            self.assertEqual(future.result(), 3)
+        bare = time.time() - started_at
+
+        started_at = time.time()
+        for _ in range(0, count):
+            self.assertEqual(await build.call("main", args), 3)
+        pipeline = time.time() - started_at
+
+        # a benchmark only, wall clock time is way too noisy to assert upon
+        logging.info("Calls: bare {0:.0f}/s, through the pipeline {1:.0f}/s ({2:.2f}x)".format(
+            count / bare, count / pipeline, pipeline / bare))
+
+    @gen_test
+    async def test_deferred_timeout(self):
+        build = JavascriptBuild()
+
+        def defer_forever():
+            async def flush():
+                await sleep(60)
+
+            PromiseContext.current.get().defer(asyncio.Future(), flush)
+
+        build.context.expose(defer_forever)
+
+        build.add_source("""
+            function main(args)
+            {
+                defer_forever();
+                return 1;
+            }
+
+            main.allow_call = true;
+        """)
+
+        started_at = time.time()
+
+        # what the call has deferred counts against its timeout too
+        with self.assertRaises(APIError) as error:
+            await build.call("main", {}, call_timeout=0.5)
+
+        self.assertEqual(error.exception.code, 408)
+        self.assertLess(time.time() - started_at, 5)
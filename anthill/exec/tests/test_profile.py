@@ -0,0 +1,177 @@
+
+from tornado.gen import sleep
+from tornado.testing import AsyncTestCase, gen_test
+
+from .. model.profile import ProfileWriter, ProfileCache, merge_fields, can_merge_fields
+from .. model.util import APIError
+
+from anthill.common import singleton
+
+import asyncio
+
+
+class RecordingProfileWriter(ProfileWriter):
+    """
+    Records the updates instead of sending them to the profile service
+    """
+
+    def __init__(self):
+        super(RecordingProfileWriter, self).__init__()
+        # nothing is flushed on its own during the tests
+        self.window = 60
+        self.sent = []
+        self.delay = 0
+
+    async def __request__(self, gamespace, account, update):
+        self.sent.append((update.path, update.fields, update.merge))
+        if self.delay:
+            await sleep(self.delay)
+        if update.path == "bad":
+            raise APIError(400, "bad_update")
+        return update.fields
+
+
+class ProfileTestCase(AsyncTestCase):
+    def setUp(self):
+        super(ProfileTestCase, self).setUp()
+        singleton.Singleton.objects.pop(RecordingProfileWriter, None)
+        self.writer = RecordingProfileWriter()
+
+    def test_merge_fields(self):
+        old = {"a": 1, "b": {"c": 1, "d": 2}, "e": 1}
+        merge_fields(old, {"a": 2, "b": {"c": None, "f": 3}, "e": {"g": 1}, "h": None})
+
+        # objects are merged, None deletes a field, an object is not merged into a plain value
+        self.assertEqual(old, {"a": 2, "b": {"c": None, "d": 2, "f": 3}, "e": 1, "h": None})
+
+        self.assertTrue(can_merge_fields({"a": {"b": 1}}, {"a": {"c": 1}}))
+        self.assertTrue(can_merge_fields({"a": 1}, {"b": {"c": 1}}))
+        # the field is deleted first, and then replaced with an object
+        self.assertFalse(can_merge_fields({"a": None}, {"a": {"b": 1}}))
+        self.assertFalse(can_merge_fields({"a": {"b": None}}, {"a": {"b": {"c": 1}}}))
+
+    def test_profile_cache(self):
+        cache = ProfileCache(ttl=60)
+
+        self.assertEqual(cache.get("stats"), (False, None))
+
+        cache.set("stats", {"level": 2, "items": {"sword": 1}})
+
+        # a path below the cached one is served from it
+        self.assertEqual(cache.get("stats"), (True, {"level": 2, "items": {"sword": 1}}))
+        self.assertEqual(cache.get("stats/items/sword"), (True, 1))
+        self.assertEqual(cache.get("stats/missing/field"), (True, None))
+        # a path above is not
+        self.assertEqual(cache.get(""), (False, None))
+
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 2)
+
+    @gen_test
+    async def test_profile_cache_expiry(self):
+        cache = ProfileCache(ttl=0.5)
+        cache.set("stats", {"level": 2})
+
+        self.assertEqual(cache.get("stats"), (True, {"level": 2}))
+        await sleep(0.6)
+        self.assertEqual(cache.get("stats"), (False, None))
+
+    def test_profile_cache_invalidation(self):
+        cache = ProfileCache(ttl=60)
+
+        cache.set("stats", {"level": 2})
+        cache.set("items", {"sword": 1})
+
+        # everything below the path is invalidated
+        cache.invalidate("stats/level")
+        self.assertEqual(cache.get("stats"), (False, None))
+        self.assertEqual(cache.get("items"), (True, {"sword": 1}))
+
+        # as well as above
+        cache.set("items/sword", 1)
+        cache.set("stats", {"level": 3})
+        cache.invalidate("items")
+        self.assertEqual(cache.get("items/sword"), (False, None))
+        self.assertEqual(cache.get("stats"), (True, {"level": 3}))
+
+        # the whole profile
+        cache.invalidate()
+        self.assertEqual(cache.get("stats"), (False, None))
+
+    @gen_test
+    async def test_merge_consecutive(self):
+        first = self.writer.update(1, 1, "stats", {"a": 1})
+        second = self.writer.update(1, 1, "stats", {"b": {"c": 1}})
+        third = self.writer.update(1, 1, "stats", {"b": {"d": 2}})
+
+        self.assertIs(first, second)
+        self.assertIs(first, third)
+
+        await self.writer.flush(1, 1)
+
+        self.assertEqual(self.writer.sent, [("stats", {"a": 1, "b": {"c": 1, "d": 2}}, True)])
+        self.assertEqual(await first, {"a": 1, "b": {"c": 1, "d": 2}})
+        self.assertEqual(self.writer.stats()["updates"], 3)
+        self.assertEqual(self.writer.stats()["requests"], 1)
+
+    @gen_test
+    async def test_functions_not_merged(self):
+        increment = {"coins": {"@func": "++", "@value": 1}}
+
+        self.writer.update(1, 1, "", increment)
+        self.writer.update(1, 1, "", increment)
+        # nothing is merged into an update with functions either
+        self.writer.update(1, 1, "", {"level": 2})
+        # nor into an update that replaces the path
+        self.writer.update(1, 1, "items", {"sword": 1}, merge=False)
+        self.writer.update(1, 1, "items", {"shield": 1})
+        # nor an update of an overlapping path into an older one
+        self.writer.update(1, 1, "", {"level": 3})
+
+        await self.writer.flush(1, 1)
+
+        self.assertEqual(self.writer.sent, [
+            ("", increment, True),
+            ("", increment, True),
+            ("", {"level": 2}, True),
+            ("items", {"sword": 1}, False),
+            ("items", {"shield": 1}, True),
+            ("", {"level": 3}, True)
+        ])
+
+    @gen_test
+    async def test_flush_order(self):
+        self.writer.delay = 0.1
+
+        first = self.writer.update(1, 1, "a", {"v": 1})
+        flushing = asyncio.ensure_future(self.writer.flush(1, 1))
+        await sleep(0.01)
+
+        # made while the first one is being sent
+        second = self.writer.update(1, 1, "b", {"v": 2})
+
+        # what a profile.get does before reading the profile
+        await self.writer.flush(1, 1)
+        self.writer.sent.append(("get", None, None))
+
+        await flushing
+
+        self.assertEqual([path for path, fields, merge in self.writer.sent], ["a", "b", "get"])
+        self.assertTrue(first.done())
+        self.assertTrue(second.done())
+
+    @gen_test
+    async def test_error_propagation(self):
+        first = self.writer.update(1, 1, "bad", {"a": 1})
+        second = self.writer.update(1, 1, "bad", {"b": 1})
+        good = self.writer.update(1, 1, "good", {"c": 1})
+
+        await self.writer.flush(1, 1)
+
+        # every caller whose update has been merged into the failed one gets the error
+        for future in (first, second):
+            with self.assertRaises(APIError) as error:
+                await future
+            self.assertEqual(error.exception.code, 400)
+
+        self.assertEqual(await good, {"c": 1})
@@ -0,0 +1,104 @@
+
+from tornado.gen import sleep, Future
+from tornado.testing import AsyncTestCase, gen_test
+
+from .. model.repository import SharedSourceCodeRoot, GitOperationScheduler
+
+from shutil import rmtree
+
+import asyncio
+import tempfile
+
+
+class IdleScheduler(GitOperationScheduler):
+    """
+    Keeps the operations queued, so nothing is actually cloned
+    """
+
+    def __process__(self):
+        pass
+
+
+class RepositoryTestCase(AsyncTestCase):
+    def setUp(self):
+        super(RepositoryTestCase, self).setUp()
+        self.root_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.root_dir, ignore_errors=True)
+        super(RepositoryTestCase, self).tearDown()
+
+    def test_shared_repository_keys(self):
+        root = SharedSourceCodeRoot(self.root_dir, scheduler=IdleScheduler())
+        url = "git@example.com:game/scripts.git"
+
+        a = root.project(1, "scripts", url, "master", ssh_private_key="key-a")
+        b = root.project(2, "scripts", url, "master", ssh_private_key="key-b")
+        c = root.project(3, "scripts", url, "master", ssh_private_key="key-a")
+
+        # gamespaces with different keys never share a checkout
+        self.assertIsNot(a, b)
+        self.assertNotEqual(a.project_dir, b.project_dir)
+        self.assertNotEqual(a.build("abcdef").build_dir, b.build("abcdef").build_dir)
+
+        # while the ones with the same key do
+        self.assertIs(a, c)
+
+        public_a = root.project(1, "scripts", "https://example.com/game/scripts.git", "master")
+        public_b = root.project(2, "scripts", "https://example.com/game/scripts.git", "master")
+        self.assertIs(public_a, public_b)
+
+    @gen_test
+    async def test_scheduler_limit(self):
+        scheduler = GitOperationScheduler(max_parallel=2)
+        state = {"running": 0, "max_running": 0}
+
+        async def operation():
+            state["running"] += 1
+            state["max_running"] = max(state["max_running"], state["running"])
+            await sleep(0.05)
+            state["running"] -= 1
+
+        operations = [scheduler.schedule(str(i), operation) for i in range(0, 6)]
+
+        while scheduler.completed < len(operations):
+            await sleep(0.01)
+
+        self.assertEqual(state["max_running"], 2)
+        self.assertEqual(scheduler.stats()["queue"], 0)
+        self.assertEqual(scheduler.stats()["running"], 0)
+
+    @gen_test
+    async def test_scheduler_waiters_first(self):
+        scheduler = GitOperationScheduler(max_parallel=1)
+        started = []
+        blocker = Future()
+
+        async def operation(name):
+            started.append(name)
+            if name == "first":
+                await blocker
+
+        scheduler.schedule("first", lambda: operation("first"))
+        scheduler.schedule("a", lambda: operation("a"))
+        b = scheduler.schedule("b", lambda: operation("b"))
+        scheduler.schedule("c", lambda: operation("c"))
+
+        await sleep(0.01)
+        self.assertEqual(started, ["first"])
+
+        # someone is waiting for "b", so it goes before the ones scheduled earlier
+        waiting = Future()
+        waiter = asyncio.ensure_future(b.wait(waiting))
+        await sleep(0.01)
+        self.assertEqual(b.waiters, 1)
+
+        blocker.set_result(None)
+
+        while scheduler.completed < 4:
+            await sleep(0.01)
+
+        waiting.set_result(True)
+        await waiter
+
+        self.assertEqual(started, ["first", "b", "a", "c"])
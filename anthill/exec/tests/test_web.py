@@ -0,0 +1,137 @@
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application, RequestHandler
+from tornado.gen import sleep
+
+from anthill.common import singleton
+
+from .. model.web import WebClient, StreamAborted, ResponseTooLarge, STREAMING_SUPPORTED
+
+import asyncio
+
+CHUNK = b"x" * 65536
+CHUNKS = 16
+
+
+class BodyHandler(RequestHandler):
+    def get(self):
+        # the client reads it in chunks anyway
+        self.write(CHUNK * CHUNKS)
+
+
+class WebTestCase(AsyncHTTPTestCase):
+    """
+    Runs against the tornado anthill-common pins (5.1), StreamingConnection relies on its internals
+    """
+
+    def get_app(self):
+        return Application([("/body", BodyHandler)])
+
+    def setUp(self):
+        super(WebTestCase, self).setUp()
+        singleton.Singleton.objects.pop(WebClient, None)
+        self.client = WebClient()
+
+    def tearDown(self):
+        # let both sides of an aborted connection notice it's closed
+        self.io_loop.run_sync(lambda: sleep(0.1))
+        singleton.Singleton.objects.pop(WebClient, None)
+        super(WebTestCase, self).tearDown()
+
+    def request(self):
+        return HTTPRequest(self.get_url("/body"), request_timeout=10)
+
+    def test_streaming_supported(self):
+        # the pinned tornado has everything StreamingConnection relies on
+        self.assertTrue(STREAMING_SUPPORTED)
+        self.assertIsNotNone(self.client.stream_client)
+
+    @gen_test
+    async def test_stream_pause(self):
+        received = []
+        resume = asyncio.Future()
+
+        def streaming_callback(chunk):
+            received.append(len(chunk))
+            if len(received) == 1:
+                return resume
+
+        fetch = asyncio.ensure_future(self.client.fetch(self.request(), streaming_callback=streaming_callback))
+
+        await sleep(0.2)
+        # nothing is read while the callback's future is pending
+        self.assertEqual(len(received), 1)
+
+        resume.set_result(True)
+        await fetch
+        self.assertEqual(sum(received), len(CHUNK) * CHUNKS)
+
+    @gen_test
+    async def test_stream_abort(self):
+        received = []
+
+        def streaming_callback(chunk):
+            received.append(len(chunk))
+            return False
+
+        with self.assertRaises(StreamAborted):
+            await self.client.fetch(self.request(), streaming_callback=streaming_callback)
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(self.client.hosts["127.0.0.1:{0}".format(self.get_http_port())].errors, 1)
+
+    @gen_test
+    async def test_stream_abort_paused(self):
+        received = []
+
+        async def stop():
+            await sleep(0.1)
+            return False
+
+        def streaming_callback(chunk):
+            received.append(len(chunk))
+            return asyncio.ensure_future(stop())
+
+        with self.assertRaises(StreamAborted):
+            await self.client.fetch(self.request(), streaming_callback=streaming_callback)
+
+        self.assertEqual(len(received), 1)
+
+    @gen_test
+    async def test_stream_too_large(self):
+        received = []
+
+        with self.assertRaises(ResponseTooLarge):
+            await self.client.fetch(
+                self.request(), max_body_size=len(CHUNK) * 2, streaming_callback=received.append)
+
+        self.assertLess(sum(len(chunk) for chunk in received), len(CHUNK) * CHUNKS)
+
+    @gen_test
+    async def test_stream_buffered(self):
+        # without the streaming internals the body is fetched as a whole, then passed in chunks
+        self.client.stream_client = None
+
+        received = []
+        resume = asyncio.Future()
+
+        def streaming_callback(chunk):
+            received.append(len(chunk))
+            if len(received) == 1:
+                return resume
+
+        fetch = asyncio.ensure_future(self.client.fetch(self.request(), streaming_callback=streaming_callback))
+
+        await sleep(0.2)
+        self.assertEqual(len(received), 1)
+
+        resume.set_result(True)
+        response = await fetch
+        self.assertEqual(sum(received), len(CHUNK) * CHUNKS)
+        self.assertEqual(response.body, b"")
+
+        def abort(chunk):
+            return False
+
+        with self.assertRaises(StreamAborted):
+            await self.client.fetch(self.request(), streaming_callback=abort)
@@ -24,5 +24,6 @@ setup(
         'https://cdn.anthillplatform.org/python/v8py'
     ],
     zip_safe=False,
+    python_requires='>=3.7',
     install_requires=DEPENDENCIES
 )